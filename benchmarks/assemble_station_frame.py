@@ -0,0 +1,50 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from functools import reduce
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "src"))
+from functions import merge_dfs, assemble_station_frame
+
+
+def parameter_frames(years, parameters, gaps=0.02, seed=0):
+    """
+    Synthetic 10 minute station data, one frame per parameter with a fraction of random gaps so the time axes differ.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range("2000-01-01", periods=years * 365 * 144, freq="10min", tz="UTC")
+    frames = []
+    for i in range(parameters):
+        keep = rng.random(len(times)) >= gaps
+        frames.append(pd.DataFrame({"time": times[keep], "P{}".format(i): rng.normal(size=keep.sum())}))
+    return frames
+
+
+def timed(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = function()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best, out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--years', '-y', help="Years of 10 minute data", type=int, default=10)
+    parser.add_argument('--parameters', '-p', help="Number of parameters", type=int, default=6)
+    parser.add_argument('--gaps', '-g', help="Fraction of missing timestamps per parameter", type=float, default=0.02)
+    parser.add_argument('--repeat', '-r', help="Number of repetitions, the best time is reported", type=int, default=3)
+    args = vars(parser.parse_args())
+
+    frames = parameter_frames(args["years"], args["parameters"], gaps=args["gaps"])
+    print("{} parameters, {} rows each".format(len(frames), len(frames[0])))
+    merge_time, merged = timed(lambda: reduce(merge_dfs, frames).sort_values(by="time").reset_index(drop=True), args["repeat"])
+    assemble_time, assembled = timed(lambda: assemble_station_frame(frames), args["repeat"])
+    pd.testing.assert_frame_equal(merged, assembled)
+    print("Pairwise merges:        {:.3f} s".format(merge_time))
+    print("assemble_station_frame: {:.3f} s".format(assemble_time))
+    print("Speedup:                {:.1f}x".format(merge_time / assemble_time))
@@ -0,0 +1,178 @@
+"""
+Sample payloads in the format served by each data source.
+
+Payloads are generated deterministically relative to the current time so that the default download windows of the
+sources (last weeks, current year) are covered. A recorded payload saved in benchmarks/fixtures/{name} replaces the
+generated one, see load().
+"""
+import io
+import os
+import json
+import zipfile
+import netCDF4
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+folder = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+
+
+def load(name, generate):
+    """
+    Recorded payload benchmarks/fixtures/{name} if it exists, otherwise the generated payload.
+
+    :param name: File name of the recorded payload
+    :param generate: Function returning the generated payload (bytes)
+    :return: bytes
+    """
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read()
+    return generate()
+
+
+def now():
+    return datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+
+
+def dwd_zip(parameters, days=550, seed=0):
+    """
+    DWD 10 minute product zip (recent archive) with a semicolon separated produkt_*.txt member.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(now() - timedelta(days=days), now(), freq="10min")
+    df = pd.DataFrame({"STATIONS_ID": 2559, "MESS_DATUM": times.strftime("%Y%m%d%H%M"), "  QN": 3})
+    for p in parameters:
+        values = np.round(rng.normal(10, 5, len(times)), 1)
+        values[rng.random(len(times)) < 0.01] = -999
+        df[p] = values
+    df["eor"] = "eor"
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("produkt_zehn_min_recent_02559.txt", df.to_csv(sep=";", index=False))
+        z.writestr("Metadaten_Geographie_02559.txt", "Stations_id;Stationshoehe\n2559;100\n")
+    return buffer.getvalue()
+
+
+def geosphere_json(parameters, days=14, seed=0):
+    """
+    Geosphere klima-v2-10min GeoJSON response.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(now() - timedelta(days=days), now(), freq="10min")
+    data = {p: {"name": p, "unit": "", "data": [None if v < -1.5 else round(float(v), 1) for v in rng.normal(0, 1, len(times))]} for p in parameters}
+    return json.dumps({"media_type": "application/json", "type": "FeatureCollection", "version": "v1",
+                       "timestamps": [t.strftime("%Y-%m-%dT%H:%M+00:00") for t in times],
+                       "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [14.0, 47.0]},
+                                     "properties": {"parameters": data, "station": "6512"}}]}).encode("utf-8")
+
+
+def arso_xml(station, parameters, days=14, seed=0):
+    """
+    ARSO archive data.xml response, a javascript object with the half hourly points keyed by minutes since 1800.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(now() - timedelta(days=days), now(), freq="30min")
+    minutes = ((times - pd.Timestamp(1800, 1, 1)) // pd.Timedelta(minutes=1)).astype(np.int64)
+    params = ",".join('p{}:{{pid:"{}",name:"Parameter {}",s:"x",l:"Parameter {}",unit:"-"}}'.format(i, p, p, p) for i, p in enumerate(parameters))
+    points = ",".join("_{}:{{{}}}".format(m, ",".join('p{}:"{:.1f}"'.format(i, v) for i, v in enumerate(rng.normal(10, 5, len(parameters))))) for m in minutes)
+    return 'AcademaPUX.processArchiveData({{tt:"halfhourly",params:{{{}}},points:{{_{}:{{{}}}}}}});'.format(params, station, points).encode("utf-8")
+
+
+def mistral_json(stations, days=7, seed=0):
+    """
+    Mistral Meteohub observations response covering several stations.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(now() - timedelta(days=days), now(), freq="h")
+    refs = [t.strftime("%Y-%m-%dT%H:%M:%S") for t in times]
+    data = []
+    for station in stations:
+        prod = [{"var": p, "lev": [103, 2000, None, None], "trange": [254, 0, 0],
+                 "val": [{"ref": r, "val": round(float(v), 2), "rel": 1} for r, v in zip(refs, rng.normal(10, 5, len(refs)))]}
+                for p in station["parameters"]]
+        data.append({"stat": {"lat": station["lat"], "lon": station["lng"], "net": station["network"],
+                              "details": [{"var": "B01019", "val": station["id"]}]}, "prod": prod})
+    return json.dumps({"data": data}).encode("utf-8")
+
+
+def thredds_nc(parameters, seed=0):
+    """
+    Thredds yearly hourly station NetCDF file for the current year.
+    """
+    rng = np.random.default_rng(seed)
+    start = datetime(now().year, 1, 1)
+    times = np.arange(pd.Timestamp(start).timestamp(), pd.Timestamp(now()).timestamp(), 3600.0)
+    nc = netCDF4.Dataset("thredds.nc", "w", memory=1024)
+    nc.createDimension("time", None)
+    variable = nc.createVariable("time", "f8", ("time",))
+    variable.units = "seconds since 1970-01-01 00:00:00"
+    variable[:] = times
+    for p in parameters:
+        nc.createVariable(p, "f4", ("time",), fill_value=-9999.0)[:] = rng.normal(10, 5, len(times))
+    return bytes(nc.close())
+
+
+def vqca44_csv(stations=300, day=None, seed=0):
+    """
+    MeteoSwiss VQCA44 daily file with hourly values for all stations.
+    """
+    rng = np.random.default_rng(seed)
+    day = day or now().replace(hour=0) - timedelta(days=1)
+    times = pd.date_range(day, periods=24, freq="h")
+    rows = len(times) * stations
+    df = pd.DataFrame({"Station/Location": np.repeat(["S{:03d}".format(i) for i in range(stations)], len(times)),
+                       "Date": np.tile(times.strftime("%Y%m%d%H"), stations)})
+    for i in range(20):
+        values = np.round(rng.normal(10, 5, rows), 1).astype(object)
+        values[rng.random(rows) < 0.05] = "-"
+        df["P{:02d}".format(i)] = values
+    return df.to_csv(sep=";", index=False).encode("utf-8")
+
+
+def bafu_csv(days=30, seed=0):
+    """
+    BAFU hydrodata station csv file with 10 minute values.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(now() - timedelta(days=days), now(), freq="10min", tz="Europe/Zurich")
+    return pd.DataFrame({"Time": times.strftime("%Y-%m-%dT%H:%M:%S%z"), "Value": np.round(rng.normal(400, 1, len(times)), 3)}).to_csv(index=False).encode("utf-8")
+
+
+def totalinflowlakes_txt(days=10, seed=0):
+    """
+    BAFU TotalInflowLakes hourly forecast file.
+    """
+    rng = np.random.default_rng(seed)
+    times = pd.date_range(now().replace(hour=0), periods=24 * days, freq="h")
+    lines = ["Total inflow forecast", "Generated {}".format(now().isoformat()), "  dd mm yyyy hh        Q       Qmin       Qmax"]
+    for t, q in zip(times, rng.uniform(10, 100, len(times))):
+        lines.append("  {:02d} {:02d} {:04d} {:02d} {:10.3f} {:10.3f} {:10.3f}".format(t.day, t.month, t.year, t.hour, q, q * 0.8, q * 1.2))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def cosmo_zip(members=11, hours=24, size=50, seed=0):
+    """
+    COSMO ensemble forecast zip with one NetCDF file per member and time step block.
+    """
+    rng = np.random.default_rng(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as z:
+        for m in range(members):
+            nc = netCDF4.Dataset("member.nc", "w", memory=1024)
+            nc.createDimension("time", None)
+            nc.createDimension("y", size)
+            nc.createDimension("x", size)
+            time = nc.createVariable("time", "f8", ("time",))
+            time.units = "hours since {}".format(now().strftime("%Y-%m-%d 00:00:00"))
+            time[:] = np.arange(m * hours, (m + 1) * hours)
+            nc.createVariable("lat", "f4", ("y", "x"))[:] = rng.random((size, size))
+            for name in ["T_2M", "U", "V"]:
+                nc.createVariable(name, "f4", ("time", "y", "x"), zlib=True)[:] = rng.normal(size=(hours, size, size))
+            packed = nc.createVariable("TOT_PREC", "i2", ("time", "y", "x"), zlib=True, fill_value=-32767)
+            packed.scale_factor = 0.01
+            packed.add_offset = 10.0
+            packed[:] = np.round(rng.uniform(0, 300, (hours, size, size)), 2)
+            z.writestr("member_{:03d}.nc".format(m), bytes(nc.close()))
+    return buffer.getvalue()
@@ -0,0 +1,49 @@
+"""
+Cold start time of main.py for each source.
+
+Each measurement runs in a fresh interpreter and times the imports needed before the download starts:
+- eager: all the source modules, as main.py imported them before the source registry.
+- lazy: the source registry and the module of the selected source only.
+"""
+import os
+import sys
+import argparse
+import subprocess
+src = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "src")
+sys.path.append(src)
+from sources import registry
+
+script = """
+import sys, time, warnings, importlib
+warnings.simplefilter("ignore")
+start = time.perf_counter()
+{}
+print(time.perf_counter() - start, " ".join(m for m in ["pandas", "netCDF4", "paramiko"] if m in sys.modules))
+"""
+
+
+def measure(code, repeat):
+    """
+    :return: Best time in seconds over repeat fresh interpreters and the heavy modules that were loaded
+    """
+    best, modules = None, ""
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", script.format(code)], cwd=src, check=True, capture_output=True, text=True).stdout.split(" ", 1)
+        if best is None or float(out[0]) < best:
+            best, modules = float(out[0]), out[1].strip() if len(out) > 1 else ""
+    return best, modules
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', '-r', help="Number of fresh interpreters per measurement, the best time is reported", type=int, default=5)
+    args = vars(parser.parse_args())
+
+    modules = sorted(set(s.module for s in registry.values()))
+    eager, eager_modules = measure("\n".join("import {}".format(m) for m in modules), args["repeat"])
+    print("{:<22}{:>9}{:>9}{:>9}   {}".format("Source", "Eager", "Lazy", "Speedup", "Heavy modules loaded (lazy)"))
+    for name, source in registry.items():
+        lazy, lazy_modules = measure("import sources\nimportlib.import_module(sources.registry['{}'].module)".format(name), args["repeat"])
+        print("{:<22}{:>8.3f}s{:>8.3f}s{:>8.1f}x   {}".format(name, eager, lazy, eager / lazy, lazy_modules))
+    help_time, _ = measure("import sources", args["repeat"])
+    print("{:<22}{:>8.3f}s{:>8.3f}s{:>8.1f}x".format("main.py -h", eager, help_time, eager / help_time))
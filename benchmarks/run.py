@@ -0,0 +1,367 @@
+"""
+Benchmark the processing path of each source offline.
+
+Every source is run end to end against local stand-ins of its servers (benchmarks/servers.py) serving sample payloads
+(benchmarks/fixtures.py), and its parse/merge/write stages are also timed on their own. Each source runs in a separate
+process so that the peak memory is reported per source.
+
+    python benchmarks/run.py                     Run all the benchmarks and compare to benchmarks/baseline.json
+    python benchmarks/run.py -s dwd thredds      Run some of the benchmarks
+    python benchmarks/run.py --save              Store the results as the new baseline
+    python benchmarks/run.py --fail              Exit with an error if a stage is slower than the baseline
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import resource
+import tempfile
+import subprocess
+from io import BytesIO
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+repository = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.append(os.path.join(repository, "src"))
+sys.path.append(os.path.dirname(os.path.realpath(__file__)))
+
+baseline_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "baseline.json")
+
+
+class timer(object):
+    """
+    Collect the durations of named stages, the best of several repetitions is kept.
+
+    Checks of the outputs are collected in checks and run after the peak memory of the benchmark has been measured.
+    """
+    def __init__(self):
+        self.stages = {}
+        self.checks = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        yield
+        duration = time.perf_counter() - start
+        self.stages[name] = min(self.stages.get(name, duration), duration)
+
+
+def dwd(t, folder, repeat):
+    import dwd
+    import fixtures
+    from servers import fixture_server, redirect
+    from functions import merge_station_years, assemble_station_frame
+    parameters = {"air_temperature": ["TT_10", "RF_10"], "wind": ["DD_10", "FF_10"], "precipitation": ["RWS_10"],
+                  "solar": ["GS_10"]}
+    payloads = {p: fixtures.load("dwd_{}.zip".format(p), lambda: fixtures.dwd_zip(parameters[p])) for p in parameters}
+    for _ in range(repeat):
+        with t.stage("parse"):
+            frames = [dwd.read_zip(payloads[p], parameters[p]) for p in parameters]
+        with t.stage("assemble"):
+            df = assemble_station_frame(frames)
+        shutil.rmtree(os.path.join(folder, "write"), ignore_errors=True)
+        with t.stage("write"):
+            merge_station_years(os.path.join(folder, "write"), df)
+    server = fixture_server([(r"/{}/".format(p), payloads[p]) for p in parameters])
+    with redirect(server):
+        with t.stage("run"):
+            dwd.dwd_meteodata(os.path.join(folder, "run"))
+    server.close()
+    return server.bytes, server.bytes / sum(len(v) for v in payloads.values()) * len(df)
+
+
+def geosphere(t, folder, repeat):
+    import geosphere
+    import fixtures
+    from servers import fixture_server, redirect
+    from functions import merge_station_years
+    parameters = ["cglo", "dd", "p", "rf", "rr", "tl", "ffam"]
+    payload = fixtures.load("geosphere.json", lambda: fixtures.geosphere_json(parameters))
+    for _ in range(repeat):
+        with t.stage("parse"):
+            df = geosphere.parse_geosphere_data(payload, parameters)
+        shutil.rmtree(os.path.join(folder, "write"), ignore_errors=True)
+        with t.stage("write"):
+            merge_station_years(os.path.join(folder, "write"), df)
+    server = fixture_server([(r"klima-v2-10min", payload)])
+    with redirect(server):
+        with t.stage("run"):
+            geosphere.geosphere_meteodata(os.path.join(folder, "run"))
+    server.close()
+    return server.bytes, server.requests * len(df)
+
+
+def arso(t, folder, repeat):
+    import arso
+    import fixtures
+    from servers import fixture_server, redirect
+    from functions import merge_station_years
+    payload = fixtures.load("arso.xml", lambda: fixtures.arso_xml("2213", ["12", "26", "21", "15", "23", "27", "18"]))
+    for _ in range(repeat):
+        with t.stage("parse"):
+            df = arso.parse_arso_data(payload, "2213")
+        shutil.rmtree(os.path.join(folder, "write"), ignore_errors=True)
+        with t.stage("write"):
+            merge_station_years(os.path.join(folder, "write"), df)
+    server = fixture_server([(r"data\.xml", payload)])
+    with redirect(server):
+        with t.stage("run"):
+            arso.arso_meteodata(os.path.join(folder, "run"))
+    server.close()
+    return server.bytes, server.requests * len(df)
+
+
+def mistral(t, folder, repeat):
+    import base64
+    import mistral
+    import fixtures
+    from servers import fixture_server, redirect
+    from functions import merge_station_years
+    stations = [
+        {"id": "trn196", "parameters": ['B14198', 'B12101', 'B13003', 'B11001', 'B11002'], "lat": 46.06192, "lng": 11.12041, "network": "mnw"},
+        {"id": "vnt387", "parameters": ['B14198', 'B12101', 'B13003', 'B11001', 'B11002'], "lat": 45.64268, "lng": 10.73399, "network": "mnw"},
+        {"id": "lmb341", "parameters": ['B14198', 'B12101', 'B13003', 'B11001', 'B11002'], "lat": 45.60308, "lng": 9.8966, "network": "mnw"},
+        {"id": "tignale_oldesio", "parameters": ['B11002', 'B12101', 'B13011', 'B11001', 'B14198', 'B13003'], "lat": 45.73262, "lng": 10.72092, "network": "dpcn-lombardia"},
+        {"id": "Tavernola Bergamasca Gallinarga", "parameters": ['B12101', 'B13003', 'B11001', 'B11002', 'B13011'], "lat": 45.69633, "lng": 10.05422, "network": "dpcn-lombardia"},
+        {"id": "Costa Volpino v.Nazionale", "parameters": ['B14198', 'B12101', 'B13003', 'B11001', 'B11002', 'B13011'], "lat": 45.82716, "lng": 10.09706, "network": "dpcn-lombardia"},
+        {"id": "Dervio v.S.Cecilia", "parameters": ['B12101', 'B13003', 'B11001', 'B11002', 'B13011'], "lat": 46.06896, "lng": 9.30539, "network": "dpcn-lombardia"},
+        {"id": "Porlezza torrente", "parameters": ['B14198', 'B12101', 'B13003', 'B11001', 'B11002', 'B13011'], "lat": 46.03777, "lng": 9.1408, "network": "dpcn-lombardia"}
+    ]
+    payloads = {n: fixtures.load("mistral_{}.json".format(n), lambda: fixtures.mistral_json([s for s in stations if s["network"] == n])) for n in ["mnw", "dpcn-lombardia"]}
+    for _ in range(repeat):
+        with t.stage("parse"):
+            frames = {}
+            for n in payloads:
+                frames.update(mistral.read_observations(json.loads(payloads[n])["data"], [s for s in stations if s["network"] == n]))
+        shutil.rmtree(os.path.join(folder, "write"), ignore_errors=True)
+        with t.stage("write"):
+            for station, df in frames.items():
+                merge_station_years(os.path.join(folder, "write", station), df)
+    claims = base64.urlsafe_b64encode(json.dumps({"exp": time.time() + 3600}).encode("utf-8")).decode("utf-8").rstrip("=")
+    token = json.dumps("header.{}.signature".format(claims)).encode("utf-8")
+    server = fixture_server([(r"auth/login", token), (r"networks=mnw", payloads["mnw"]),
+                             (r"networks=dpcn-lombardia", payloads["dpcn-lombardia"])])
+    with redirect(server):
+        with t.stage("run"):
+            mistral.mistral_meteodata(os.path.join(folder, "run"), "user", "password")
+    server.close()
+    return server.bytes, sum(len(df) for df in frames.values())
+
+
+def thredds(t, folder, repeat):
+    import netCDF4
+    import thredds
+    import fixtures
+    from servers import fixture_server, redirect
+    parameters = ["time", "ta", "rh", "wd", "ws", "cumul_precip", "glo"]
+    payload = fixtures.load("thredds.nc", lambda: fixtures.thredds_nc(parameters[1:]))
+    start = datetime.utcnow() - timedelta(weeks=4)
+    for _ in range(repeat):
+        with t.stage("parse"):
+            with netCDF4.Dataset("thredds.nc", memory=payload) as nc:
+                df = thredds.read_thredds(nc, parameters, start)
+    server = fixture_server([(r"/fileServer/.*\.nc$", payload)])
+    with redirect(server, modules=[thredds]):
+        with t.stage("run"):
+            thredds.thredds_meteodata(os.path.join(folder, "run"))
+    server.close()
+    return server.bytes, server.requests * len(df)
+
+
+def meteoswiss_meteodata(t, folder, repeat):
+    import meteoswiss
+    import fixtures
+    import pandas as pd
+    from servers import sftp_server
+    remote = os.path.join(folder, "remote", "data")
+    os.makedirs(remote)
+    days = 3
+    payloads = []
+    for i in range(days):
+        day = fixtures.now().replace(hour=0) - timedelta(days=days - i)
+        payloads.append(fixtures.load("VQCA44.{}.csv".format(i), lambda: fixtures.vqca44_csv(day=day, seed=i)))
+        with open(os.path.join(remote, "VQCA44.{}.csv".format(day.strftime("%Y%m%d%H%M"))), "wb") as f:
+            f.write(payloads[-1])
+    for _ in range(repeat):
+        with t.stage("parse"):
+            df = meteoswiss.concat_vqca44([pd.read_csv(BytesIO(payload), sep=";") for payload in payloads])
+            df["time"] = pd.to_datetime(df['Date'], format='%Y%m%d%H', utc=True)
+    size, rows = sum(len(payload) for payload in payloads), len(df)
+    server = sftp_server(os.path.join(folder, "remote"))
+    with t.stage("run"):
+        meteoswiss.meteodata(os.path.join(folder, "run"), "password", ftp_host="127.0.0.1", ftp_port=server.port)
+    server.close()
+    return size, rows
+
+
+def bafu_hydrodata(t, folder, repeat):
+    import bafu
+    import fixtures
+    from servers import sftp_server
+    remote = os.path.join(folder, "remote")
+    files = {}
+    for i in range(40):
+        files["CSV/BAFU_{}_{}.csv".format(2000 + i, ["Wasserstand", "Abfluss"][i % 2])] = fixtures.load("bafu.csv", fixtures.bafu_csv)
+    for lake in ["Bielersee", "Brienzersee", "Thunersee"]:
+        for t_ in ["C1E", "C2E", "ECMWF"]:
+            files["TotalInflowLakes/{}_{}.txt".format(lake, t_)] = fixtures.load("totalinflowlakes.txt", fixtures.totalinflowlakes_txt)
+    for i in range(20):
+        for f in ["pqprevi-official", "pqprevi-unofficial"]:
+            files["{}/forecast_{}.txt".format(f, i)] = fixtures.load("totalinflowlakes.txt", fixtures.totalinflowlakes_txt)
+    for name, payload in files.items():
+        os.makedirs(os.path.dirname(os.path.join(remote, name)), exist_ok=True)
+        with open(os.path.join(remote, name), "wb") as f:
+            f.write(payload)
+    sample = os.path.join(remote, "CSV", "BAFU_2000_Wasserstand.csv")
+    for _ in range(repeat):
+        shutil.rmtree(os.path.join(folder, "parse"), ignore_errors=True)
+        with t.stage("parse"):
+            bafu.csv_process(sample, os.path.join(folder, "parse", "CSV"))
+    server = sftp_server(remote)
+    with t.stage("run"):
+        bafu.hydrodata(os.path.join(folder, "run"), server.private_key(os.path.join(folder, "key")),
+                       ftp_host="127.0.0.1", ftp_port=server.port)
+    server.close()
+    rows = sum(payload.count(b"\n") for payload in files.values())
+    return sum(len(payload) for payload in files.values()), rows
+
+
+def meteoswiss_cosmo(t, folder, repeat):
+    import meteoswiss
+    import fixtures
+    from servers import sftp_server
+    from netcdf import unzip_combine
+    remote = os.path.join(folder, "remote", "data", "forecast")
+    os.makedirs(remote)
+    os.makedirs(os.path.join(folder, "remote", "data", "reanalysis"))
+    payload = fixtures.load("cosmo.zip", fixtures.cosmo_zip)
+    days = 3
+    for i in range(days):
+        name = "VNXZ32.{}0000.zip".format((fixtures.now() - timedelta(days=i)).strftime("%Y%m%d"))
+        with open(os.path.join(remote, name), "wb") as f:
+            f.write(payload)
+    for i in range(repeat):
+        local = os.path.join(folder, "combine_{}.zip".format(i))
+        with open(local, "wb") as f:
+            f.write(payload)
+        with t.stage("combine"):
+            unzip_combine(local)
+    t.checks.append(lambda: check_combined(payload, os.path.join(folder, "combine_0.nc")))
+    server = sftp_server(os.path.join(folder, "remote"))
+    with t.stage("run"):
+        meteoswiss.cosmo(os.path.join(folder, "run"), "password", ftp_host="127.0.0.1", ftp_port=server.port)
+    server.close()
+    with zipfile.ZipFile(BytesIO(payload)) as z:
+        members = len(z.namelist())
+    return len(payload) * days, members * days
+
+
+def check_combined(payload, combined):
+    """
+    Check that a file combined by unzip_combine holds the same data as xarray.concat of the zip members, including
+    packed (scale_factor/add_offset) variables.
+    """
+    import netCDF4
+    import xarray as xr
+    with zipfile.ZipFile(BytesIO(payload)) as z:
+        members = [xr.open_dataset(xr.backends.NetCDF4DataStore(netCDF4.Dataset(name, memory=z.read(name))))
+                   for name in sorted(z.namelist())]
+    expected = xr.concat(members, dim="time")
+    with xr.open_dataset(combined) as ds:
+        xr.testing.assert_equal(ds, expected)
+        for name in ds.variables:
+            if ds[name].encoding.get("dtype") != expected[name].encoding.get("dtype"):
+                raise ValueError("Variable {} is stored as {} instead of {}".format(name, ds[name].encoding.get("dtype"), expected[name].encoding.get("dtype")))
+
+
+benchmarks = {"dwd": dwd, "geosphere": geosphere, "arso": arso, "mistral": mistral, "thredds": thredds,
+              "meteoswiss_meteodata": meteoswiss_meteodata, "bafu_hydrodata": bafu_hydrodata,
+              "meteoswiss_cosmo": meteoswiss_cosmo}
+
+
+def child(source, output, repeat):
+    """
+    Run a single benchmark in this process and write the results to a JSON file.
+    """
+    from functions import logger
+    t = timer()
+    folder = tempfile.mkdtemp(prefix="benchmark_{}_".format(source))
+    logger.root = os.path.join(folder, "logs")
+    os.environ["XDG_STATE_HOME"] = os.path.join(folder, "state")
+    try:
+        size, rows = benchmarks[source](t, folder, repeat)
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        for check in t.checks:
+            check()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    run = t.stages["run"]
+    with open(output, "w") as f:
+        json.dump({"stages": t.stages, "bytes": size, "rows": rows, "mb_per_s": size / 1e6 / run,
+                   "rows_per_s": rows / run, "peak_rss_mb": peak / 1024}, f)
+
+
+def run(source, repeat):
+    with tempfile.NamedTemporaryFile(suffix=".json") as output:
+        process = subprocess.run([sys.executable, os.path.realpath(__file__), "--child", source, "--output", output.name,
+                                  "--repeat", str(repeat)], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise ValueError("Benchmark {} failed:\n{}".format(source, process.stderr.decode("utf-8", errors="replace")))
+        with open(output.name, "r") as f:
+            return json.load(f)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline.
+
+    :return: List of stages slower than the baseline by more than the tolerance
+    """
+    slower = []
+    print("{:<22}{:<10}{:>10}{:>10}{:>9}".format("Source", "Stage", "Seconds", "Baseline", "Change"))
+    for source, result in results.items():
+        reference = baseline.get(source, {})
+        for stage, duration in result["stages"].items():
+            before = reference.get("stages", {}).get(stage)
+            change = "" if before is None else "{:+.0%}".format(duration / before - 1)
+            print("{:<22}{:<10}{:>10.3f}{:>10}{:>9}".format(source, stage, duration, "" if before is None else "{:.3f}".format(before), change))
+            if before is not None and duration > before * (1 + tolerance):
+                slower.append("{} {}".format(source, stage))
+        print("{:<22}{:.1f} MB/s, {:.0f} rows/s, peak RSS {:.0f} MB (baseline {})".format(
+            "", result["mb_per_s"], result["rows_per_s"], result["peak_rss_mb"],
+            "{:.0f} MB".format(reference["peak_rss_mb"]) if "peak_rss_mb" in reference else "-"))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', '-s', help="Benchmarks to run [{}]".format(", ".join(benchmarks)), type=str, nargs="+", default=list(benchmarks), choices=list(benchmarks))
+    parser.add_argument('--repeat', '-r', help="Number of repetitions of the stage benchmarks, the best time is reported", type=int, default=3)
+    parser.add_argument('--tolerance', '-t', help="Allowed slowdown compared to the baseline", type=float, default=0.25)
+    parser.add_argument('--save', help="Store the results as the new baseline", action="store_true")
+    parser.add_argument('--fail', help="Exit with an error if a stage is slower than the baseline", action="store_true")
+    parser.add_argument('--child', help=argparse.SUPPRESS, type=str, default=None)
+    parser.add_argument('--output', help=argparse.SUPPRESS, type=str, default=None)
+    args = vars(parser.parse_args())
+
+    if args["child"] is not None:
+        child(args["child"], args["output"], args["repeat"])
+        sys.exit(0)
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, "r") as f:
+            baseline = json.load(f)
+    results = {source: run(source, args["repeat"]) for source in args["sources"]}
+    slower = compare(results, baseline, args["tolerance"])
+    if args["save"]:
+        baseline.update(results)
+        with open(baseline_file, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to {}".format(baseline_file))
+    if len(slower) > 0:
+        print("Slower than the baseline by more than {:.0%}: {}".format(args["tolerance"], ", ".join(slower)))
+        if args["fail"]:
+            sys.exit(1)
@@ -0,0 +1,221 @@
+"""
+Local stand-ins for the remote servers used by the sources.
+
+- fixture_server: HTTP server answering requests with fixture payloads matched on the url.
+- redirect(): routes the requests of fetcher (and remote NetCDF opens) to a fixture server.
+- sftp_server: SFTP server exposing a local folder, accepts any user, password or key.
+"""
+import os
+import re
+import socket
+import netCDF4
+import paramiko
+import threading
+import requests
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import functions
+
+
+class fixture_server(object):
+    """
+    HTTP server on localhost returning the payload of the first route matching the requested url.
+
+    Requests are made to http://127.0.0.1:{port}/{original host}{original path}?{original query}.
+    """
+    def __init__(self, routes):
+        """
+        :param routes: List of tuples (regular expression, payload bytes or function of the url returning bytes)
+        """
+        self.routes = [(re.compile(pattern), payload) for pattern, payload in routes]
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class handler(BaseHTTPRequestHandler):
+            def respond(self, body):
+                url = self.path[1:]
+                for pattern, payload in server.routes:
+                    if pattern.search(url):
+                        data = payload(url) if callable(payload) else payload
+                        self.send_response(200)
+                        self.send_header("Content-Length", str(len(data)))
+                        self.end_headers()
+                        if body:
+                            self.wfile.write(data)
+                        with server.lock:
+                            server.requests += 1
+                            server.bytes += len(data)
+                        return
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://127.0.0.1:{}".format(self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def local(self, url):
+        parsed = urlparse(url)
+        return "{}/{}{}".format(self.url, parsed.netloc, parsed.path) + ("?" + parsed.query if parsed.query else "")
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class redirect_adapter(requests.adapters.HTTPAdapter):
+    def __init__(self, server, **kwargs):
+        self.server = server
+        super(redirect_adapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        request.url = self.server.local(request.url)
+        return super(redirect_adapter, self).send(request, **kwargs)
+
+
+@contextmanager
+def redirect(server, modules=()):
+    """
+    Route all requests made through functions.fetcher, and remote NetCDF files opened by the given modules, to a
+    fixture server.
+    """
+    init = functions.fetcher.__init__
+
+    def redirected_init(self, *args, **kwargs):
+        init(self, *args, **kwargs)
+        adapter = redirect_adapter(server, pool_connections=self.workers, pool_maxsize=self.workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    class netcdf(object):
+        def __getattr__(self, name):
+            return getattr(netCDF4, name)
+
+        @staticmethod
+        def Dataset(path, *args, **kwargs):
+            if isinstance(path, str) and path.startswith("http"):
+                path = server.local(path)
+            return netCDF4.Dataset(path, *args, **kwargs)
+
+    originals = [(module, getattr(module, "netCDF4")) for module in modules if hasattr(module, "netCDF4")]
+    functions.fetcher.__init__ = redirected_init
+    for module, _ in originals:
+        module.netCDF4 = netcdf()
+    try:
+        yield server
+    finally:
+        functions.fetcher.__init__ = init
+        for module, original in originals:
+            module.netCDF4 = original
+
+
+class _server(paramiko.ServerInterface):
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+
+class _handle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class _sftp(paramiko.SFTPServerInterface):
+    root = None
+
+    def local(self, path):
+        return os.path.join(self.root, os.path.normpath("/" + path).lstrip("/"))
+
+    def canonicalize(self, path):
+        return os.path.normpath("/" + path)
+
+    def list_folder(self, path):
+        try:
+            folder = self.local(path)
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(folder, f)), filename=f) for f in os.listdir(folder)]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            handle = _handle(flags)
+            handle.readfile = open(self.local(path), "rb")
+            return handle
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class sftp_server(object):
+    """
+    SFTP server on localhost serving the files below a local folder (read only).
+    """
+    def __init__(self, root):
+        self.root = root
+        self.key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(16)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        interface = type("local_sftp", (_sftp,), {"root": self.root})
+        while True:
+            try:
+                client, _ = self.socket.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, interface)
+            transport.start_server(server=_server())
+            self.transports.append(transport)
+
+    def private_key(self, path):
+        """
+        Write a private key file the server accepts, for sources that connect with a key.
+        """
+        paramiko.RSAKey.generate(2048).write_private_key_file(path)
+        return path
+
+    def close(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
@@ -1,22 +1,25 @@
 import os
+import re
 import json
-import requests
 import numpy as np
 import pandas as pd
+from itertools import chain
 from datetime import datetime, timedelta
-from functions import logger, parse_dict_string
+from functions import logger, merge_station_years, fetcher, backfill_checkpoint, watermarks
 
-def arso_meteodata(data_folder):
+def arso_meteodata(data_folder, workers=8, fmt="csv", backfill=None):
     """
     Download Meteodata from Arso
     https://meteo.arso.gov.si/met/en/app/webmet/#webmet==8Sdwx2bhR2cv0WZ0V2bvEGcw9ydlJWblR3LwVnaz9SYtVmYh9iclFGbt9SaulGdugXbsx3cs9mdl5WahxXYyNGapZXZ8tHZv1WYp5mOnMHbvZXZulWYnwCchJXYtVGdlJnOn0UQQdSf;
+
+    :param backfill: Tuple (start, end) of datetimes to backfill in monthly chunks instead of fetching the last two weeks
     """
     stations = [
         {"id": "2213", "parameters": ["12", "26", "21", "15", "23", "27", "18"]}
     ]
     failed = []
 
-    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="arso_meteodata")
     log.initialise("Download Meteodata from Arso")
 
     log.info("Ensure data folder exists.")
@@ -28,49 +31,100 @@ def arso_meteodata(data_folder):
     last_update = current_date - timedelta(weeks=2)
     url = "https://meteo.arso.gov.si/webmet/archive/data.xml?lang=en&vars={}&group=halfhourlyData0&type=halfhourly&id={}&d1={}&d2={}"
 
+    marks = watermarks(parent)
+    if backfill is None:
+        chunks = {station["id"]: [(marks.start(station["id"], station["parameters"], last_update), current_date)] for station in stations}
+    else:
+        log.info("Backfilling data from {} to {}".format(backfill[0], backfill[1]))
+        checkpoint = backfill_checkpoint(parent, backfill[0], backfill[1])
+        chunks = {station["id"]: checkpoint.chunks(1, unit="months") for station in stations}
+
+    fetch = fetcher(workers=workers, metrics=log.metrics)
+    jobs = []
     for station in stations:
-        log.info("Downloading data for station {}".format(station["id"]))
-        u = url.format(",".join(station["parameters"]), station["id"], last_update.strftime("%Y-%m-%d"), current_date.strftime("%Y-%m-%d"))
-        response = requests.get(u)
-        if response.status_code == 200:
-            try:
-                raw_data = str(response.content)
-                data = parse_dict_string(raw_data)
-                keys = data["params"].keys()
-                d = {key: [] for key in keys}
-                d["time"] = []
-                for key in data["points"]["_"+station["id"]].keys():
-                    d["time"].append(datetime(1800,1,1) + timedelta(seconds=int(key.replace("_", "")) * 60))
-                    for k in keys:
-                        if k in data["points"]["_"+station["id"]][key]:
-                            d[k].append(float(data["points"]["_"+station["id"]][key][k]))
-                        else:
-                            d[k].append(np.nan)
-                df = pd.DataFrame(d)
-                for key in keys:
-                    df = df.rename(columns={key: data["params"][key]["pid"]})
-                cols = ["time"] + sorted([col for col in df.columns if col != "time"])
-                df = df[cols]
-                for year in range(df['time'].min().year, df['time'].max().year + 1):
-                    station_year_file = os.path.join(parent, station["id"], "{}.csv".format(year))
-                    station_year_data = df[df['time'].dt.year == year]
-                    if not os.path.exists(station_year_file):
-                        log.info("Saving file new file {}.".format(station_year_file), indent=1)
-                        os.makedirs(os.path.dirname(station_year_file), exist_ok=True)
-                        station_year_data.to_csv(station_year_file, index=False)
+        for chunk in chunks[station["id"]]:
+            if backfill is not None and checkpoint.done(station["id"], chunk[0].isoformat()):
+                continue
+            jobs.append(((station, chunk), url.format(",".join(station["parameters"]), station["id"], chunk[0].strftime("%Y-%m-%d"), chunk[1].strftime("%Y-%m-%d"))))
+
+    pending = {station["id"]: 0 for station in stations}
+    for job in jobs:
+        pending[job[0][0]["id"]] += 1
+
+    completed = [((station, None), None) for station in stations if pending[station["id"]] == 0]
+    for (station, chunk), response in chain(completed, fetch.map(jobs)):
+        if chunk is not None:
+            pending[station["id"]] -= 1
+            log.info("Processing data for station {} from {} to {}".format(station["id"], chunk[0], chunk[1]))
+            if not isinstance(response, Exception) and response.status_code == 200:
+                try:
+                    with log.timer("parse"):
+                        df = parse_arso_data(response.content, station["id"])
+                    if backfill is None:
+                        merge_station_years(os.path.join(parent, station["id"]), df, fmt=fmt, log=log)
+                        marks.update(station["id"], df)
                     else:
-                        df_existing = pd.read_csv(station_year_file)
-                        df_existing['time'] = pd.to_datetime(df_existing['time'])
-                        combined = pd.concat([df_existing, station_year_data])
-                        combined = combined.drop_duplicates(subset=['time'], keep='last')
-                        combined = combined.sort_values(by='time')
-                        combined.to_csv(station_year_file, index=False)
+                        checkpoint.stage(station["id"], chunk[0].isoformat(), df)
+                except:
+                    if station["id"] not in failed:
+                        failed.append(station["id"])
+            elif station["id"] not in failed:
+                failed.append(station["id"])
+
+        if backfill is not None and pending[station["id"]] == 0 and station["id"] not in failed and not checkpoint.finished(station["id"]):
+            log.info("Merging backfill for station {}".format(station["id"]))
+            try:
+                dfs = [df for key, df in checkpoint.load(station["id"])]
+                if len(dfs) > 0:
+                    df = pd.concat(dfs)
+                    merge_station_years(os.path.join(parent, station["id"]), df, fmt=fmt, log=log)
+                    marks.update(station["id"], df)
+                checkpoint.complete(station["id"])
             except:
                 failed.append(station["id"])
-        else:
-            failed.append(station["id"])
+
+    fetch.close()
+    marks.save()
+    log.close()
+
+    if backfill is not None and len(failed) == 0:
+        checkpoint.finish()
 
     if len(failed) > 0:
         raise ValueError("Failed to download and process: {}".format(", ".join(failed)))
 
 
+def parse_arso_data(content, station_id):
+    """
+    Parse the data.xml response of the ARSO archive.
+
+    The payload is a javascript object of the form {..., params:{p0:{pid:"12", ...}, ...},
+    points:{_2213:{_117528750:{p0:"10.2", ...}, ...}}} where the point keys are minutes since 1800-01-01.
+    Neither the params nor the points entries are nested, so the points block is tokenised with a single regular
+    expression and the values are scattered into a column array by point and parameter.
+
+    :param content: Response content (bytes)
+    :param station_id: ARSO station id
+    :return: DataFrame with a time column followed by one column per parameter id (sorted)
+    """
+    text = content.decode("utf-8", errors="replace")
+    params_start = re.search(r'params"?\s*:\s*\{', text).end()
+    params = {}
+    for key, body in re.findall(r'(\w+)"?\s*:\s*\{([^{}]*)\}', text[params_start:text.find("}}", params_start) + 1]):
+        params[key] = dict(_value.findall(body))["pid"]
+
+    points_start = re.search(r'_{}"?\s*:\s*\{{'.format(station_id), text).end()
+    tokens = pd.DataFrame(_token.findall(text[points_start:text.find("}}", points_start) + 2]), columns=["point", "key", "value"])
+    start = (tokens["point"] != "").to_numpy()
+    minutes = tokens["point"].to_numpy()[start].astype("int64")
+    tokens["row"] = np.cumsum(start) - 1
+    tokens = tokens[~start & tokens["key"].isin(params.keys())]
+    values = np.full((len(minutes), len(params)), np.nan)
+    values[tokens["row"].to_numpy(), tokens["key"].map({key: i for i, key in enumerate(params.keys())}).to_numpy()] = pd.to_numeric(tokens["value"], errors="coerce").to_numpy(dtype=float)
+    df = pd.DataFrame(values, columns=list(params.values()))
+    df.insert(0, "time", pd.Timestamp(1800, 1, 1) + pd.to_timedelta(minutes, unit="m"))
+    return df[["time"] + sorted([col for col in df.columns if col != "time"])]
+
+
+_token = re.compile(r'_(\d+)"?\s*:\s*\{|(\w+)"?\s*:\s*"?((?<=")[^"]*|[^",}\s]*)')
+_value = re.compile(r'(\w+)"?\s*:\s*"?((?<=")[^"]*|[^",}\s]*)')
@@ -1,14 +1,19 @@
 import os
 import time
 import shutil
-import pysftp
+import json
+import multiprocessing
 import numpy as np
 import pandas as pd
+from io import BytesIO
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timedelta
-from functions import logger, list_nested_dir
+from functions import logger, merge_station_year, partition_years, atomic_write, write_if_changed, replace_folder, file_lock
+from sftp import sftp_pool
 
 
-def csv_process(path, folder):
+def csv_process(path, folder, fmt="csv"):
     parts = os.path.basename(path).split(".")[0].split("_")
     out_folder = os.path.join(os.path.dirname(folder), "stations", parts[1], parts[2])
     os.makedirs(out_folder, exist_ok=True)
@@ -17,20 +22,10 @@ def csv_process(path, folder):
     df['Time'] = pd.to_datetime(df['Time'])
     df['Time'] = df['Time'].dt.tz_convert('UTC')
 
-    for year in range(df['Time'].min().year, df['Time'].max().year + 1):
-        year_file = os.path.join(out_folder, os.path.basename(path).split(".")[0] + "_{}.csv".format(year))
-        year_data = df[df['Time'].dt.year == year]
-        if not os.path.exists(year_file):
+    for year, year_data in partition_years(df, time="Time"):
+        year_file = os.path.join(out_folder, os.path.basename(path).split(".")[0] + "_{}.{}".format(year, fmt))
+        if merge_station_year(year_file, year_data, time="Time", state=os.path.dirname(folder)) == "new":
             print("Saving file new file {}.".format(year_file))
-            os.makedirs(os.path.dirname(year_file), exist_ok=True)
-            year_data.to_csv(year_file, index=False)
-        else:
-            df_existing = pd.read_csv(year_file)
-            df_existing['Time'] = pd.to_datetime(df_existing['Time'])
-            combined = pd.concat([df_existing, year_data])
-            combined = combined.drop_duplicates(subset=['Time'], keep='last')
-            combined = combined.sort_values(by='Time')
-            combined.to_csv(year_file, index=False)
 
 
 def totalinflowlakes_process(path, folder):
@@ -45,33 +40,71 @@ def totalinflowlakes_process(path, folder):
         return
     if not os.path.exists(out):
         os.makedirs(out)
-    skiprows = -1
-    with open(path, 'rb') as f:
-        for line in f:
-            skiprows += 1
-            if "dd mm yyyy hh" in str(line):
-                break
-    df = pd.read_csv(path, skiprows=skiprows, delim_whitespace=True)
-    df.index = pd.to_datetime(dict(year=df.yyyy, month=df.mm, day=df.dd, hour=df.hh))
-    days = df.groupby([df.index.date]).sum(numeric_only=True).index
-    start = "{}T00:00:00"
-    end = "{}T23:59:00"
-    for i in range(1, len(days)):
-        df_d = df.loc[(df.index >= pd.Timestamp(start.format(str(days[i]))))
-                      & (df.index < pd.Timestamp(end.format(str(days[i]))))]
-        out_name = "{}_{}.csv".format(name.split(".")[0], str(days[i]))
-        df_d.to_csv(os.path.join(out, out_name), index=False)
-
-
-def hydrodata(data_folder, ssh_key, ftp_host="ftp.hydrodata.ch", ftp_user="eawag"):
+    df = read_totalinflowlakes(path)
+    days = (df["yyyy"].to_numpy() * 10000 + df["mm"].to_numpy() * 100 + df["dd"].to_numpy()).astype(np.int64)
+    order = np.argsort(days, kind="stable")
+    if (np.diff(order) < 0).any():
+        df, days = df.iloc[order], days[order]
+    lines = df.to_csv(index=False).encode("utf-8").split(b"\n")
+    edges = np.concatenate([[0], np.flatnonzero(days[1:] != days[:-1]) + 1, [len(df)]])
+    for start, end in zip(edges[1:-1], edges[2:]):
+        day = "{:04d}-{:02d}-{:02d}".format(days[start] // 10000, days[start] // 100 % 100, days[start] % 100)
+        out_name = "{}_{}.csv".format(name.split(".")[0], day)
+        write_if_changed(os.path.join(out, out_name), b"\n".join([lines[0]] + lines[start + 1:end + 1] + [b""]))
+
+
+def read_totalinflowlakes(path):
+    """
+    Read a TotalInflowLakes forecast file.
+
+    The header row is the first line containing "dd mm yyyy hh", the column types are inferred so that integer
+    columns are written as integers in the daily files.
+
+    :param path: Path to the forecast file
+    :return: DataFrame with the columns of the file
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    position = data.find(b"dd mm yyyy hh")
+    if position < 0:
+        raise ValueError("Header not found in {}".format(path))
+    data = data[data.rfind(b"\n", 0, position) + 1:]
+    return pd.read_csv(BytesIO(data), sep=r"\s+")
+
+
+def process_files(process, files, temp, folder):
+    """
+    Process a group of downloaded files in order, runs in a worker process of the merge stage.
+
+    :param process: Processing function called with (local file, output folder)
+    :param files: Remote paths of the files, relative to the temporary directory
+    :param temp: Temporary directory the files were downloaded to
+    :param folder: Output folder
+    :return: List of tuples (file, error), error is None if the file was processed
+    """
+    results = []
+    for file in files:
+        try:
+            process(os.path.join(temp, file), folder)
+            results.append((file, None))
+        except Exception as e:
+            results.append((file, e))
+    return results
+
+
+def hydrodata(data_folder, ssh_key, ftp_host="ftp.hydrodata.ch", ftp_user="eawag", ftp_port=22, fmt="csv", connections=4, workers=4):
     """
     Download Bafu data from Bafu sftp server.
+
+    The size and modification time of the remote files are stored in a manifest after each run, only files that are
+    new or have changed since the last run are downloaded and processed. Downloaded files are merged by a pool of
+    worker processes, files writing to the same station files (same file name) are processed by the same worker.
     """
-    folders = [{"name": "CSV", "operation": "merge", "process": csv_process},
+    folders = [{"name": "CSV", "operation": "merge", "process": partial(csv_process, fmt=fmt)},
                {"name": "TotalInflowLakes", "operation": "merge", "process": totalinflowlakes_process},
                {"name": "pqprevi-official", "operation": "overwrite"},
                {"name": "pqprevi-unofficial", "operation": "overwrite"}]
-    log = logger("cosmo", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("cosmo", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="bafu_hydrodata")
     log.initialise("Download Hydrodata from Bafu sftp server")
 
     log.info("Ensure data folder exists.")
@@ -79,49 +112,126 @@ def hydrodata(data_folder, ssh_key, ftp_host="ftp.hydrodata.ch", ftp_user="eawag
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    log.info("Connecting to {}".format(ftp_host))
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-    conn = pysftp.Connection(host=ftp_host, username=ftp_user, private_key=ssh_key, cnopts=cnopts)
-    log.info("Successfully connected to {}".format(ftp_host), indent=1)
-
-    temp = os.path.join(parent, "temp")
-    log.info("Downloading data to temporary directory: {}".format(temp), indent=1)
-    if os.path.exists(temp):
-        log.info("Temporary directory already exists, remove it.", indent=2)
+    log.info("Waiting for other runs writing to {}".format(parent))
+    manifest_file = os.path.join(parent, "manifest.json")
+    with file_lock(manifest_file, state=parent):
+        manifest = {}
+        if os.path.exists(manifest_file):
+            try:
+                with open(manifest_file, "r") as f:
+                    manifest = json.load(f)
+            except ValueError:
+                log.warning("Failed to read manifest, downloading all files.")
+
+        log.info("Connecting to {}".format(ftp_host))
+        pool = sftp_pool(ftp_host, ftp_user, private_key=ssh_key, port=ftp_port, connections=connections, metrics=log.metrics)
+
+        temp = os.path.join(parent, "temp")
+        log.info("Downloading data to temporary directory: {}".format(temp), indent=1)
+        if os.path.exists(temp):
+            log.info("Temporary directory already exists, remove it.", indent=2)
+            shutil.rmtree(temp)
+        os.makedirs(temp)
+
+        jobs = []
+        for folder in folders:
+            log.info("Listing files in {}".format(folder["name"]), indent=2)
+            start = time.time()
+            remote = pool.walk(folder["name"])
+            known = {f: manifest[f] for f in manifest if f.startswith(folder["name"] + "/")}
+            if folder["operation"] == "overwrite" and not os.path.exists(os.path.join(parent, folder["name"])):
+                known = {}
+            folder["remote"] = remote
+            folder["changed"] = sorted(f for f in remote if known.get(f) != remote[f])
+            folder["deleted"] = sorted(f for f in known if f not in remote)
+            log.info("Found {} files, {} new or changed and {} removed in {} seconds.".format(
+                len(remote), len(folder["changed"]), len(folder["deleted"]), round(time.time() - start)), indent=2)
+            for file in folder["changed"]:
+                local = os.path.join(temp, file)
+                os.makedirs(os.path.dirname(local), exist_ok=True)
+                jobs.append((file, file, local))
+
+        log.info("Downloading {} files with {} connections.".format(len(jobs), connections), indent=1)
+        start = time.time()
+        failed = []
+        for file, error in pool.map(jobs):
+            if error is not None:
+                log.error("Failed to download file: {}".format(file), error, indent=2)
+                failed.append(file)
+        log.info("Downloaded {} files in {} seconds.".format(len(jobs) - len(failed), round(time.time() - start)), indent=1)
+
+        pool.close()
+        log.info("Closing the connection to {}".format(ftp_host))
+
+        for folder in folders:
+            if folder["operation"] == "merge":
+                folder["groups"] = {}
+                for file in [f for f in folder["changed"] if f not in failed]:
+                    folder["groups"].setdefault(os.path.basename(file).split(".")[0], []).append(file)
+        # Forking while other sources are running on threads of the same process can copy a held lock (e.g. stdout)
+        # into the workers, so the workers are started from a clean process and shared by the merged folders
+        size = min(workers, max([len(f["groups"]) for f in folders if f["operation"] == "merge"] + [0]))
+        context = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn")
+        executor = ProcessPoolExecutor(max_workers=size, mp_context=context) if size > 0 else None
+
+        log.info("Processing downloaded data.")
+        for folder in folders:
+            log.info("Processing data from {}".format(folder["name"]), indent=1)
+            if folder["operation"] == "overwrite":
+                if len(folder["changed"]) == 0 and len(folder["deleted"]) == 0:
+                    log.info("No changes to {}.".format(folder["name"]), indent=2)
+                    continue
+                if any(f in failed for f in folder["changed"]):
+                    log.info("Keeping {} as some files failed to download.".format(folder["name"]), indent=2)
+                    continue
+                log.info("Overwriting {} with new data.".format(os.path.join(parent, folder["name"])), indent=2)
+                with log.timer("write"):
+                    staging = os.path.join(temp, ".staging", folder["name"])
+                    if os.path.exists(os.path.join(parent, folder["name"])):
+                        shutil.copytree(os.path.join(parent, folder["name"]), staging, copy_function=os.link)
+                    for file in folder["deleted"]:
+                        if os.path.exists(os.path.join(temp, ".staging", file)):
+                            os.unlink(os.path.join(temp, ".staging", file))
+                    for file in folder["changed"]:
+                        os.makedirs(os.path.dirname(os.path.join(temp, ".staging", file)), exist_ok=True)
+                        os.replace(os.path.join(temp, file), os.path.join(temp, ".staging", file))
+                    os.makedirs(staging, exist_ok=True)
+                    replace_folder(staging, os.path.join(parent, folder["name"]))
+                for file in folder["deleted"]:
+                    manifest.pop(file, None)
+                for file in folder["changed"]:
+                    manifest[file] = folder["remote"][file]
+            elif folder["operation"] == "merge":
+                groups = folder["groups"]
+                files = [f for group in groups.values() for f in group]
+                log.info("Merging {} new files from {} with {} workers.".format(len(files), folder["name"], size), indent=2)
+                start = time.time()
+                with log.timer("merge"):
+                    futures = {executor.submit(process_files, folder["process"], group, temp, os.path.join(parent, folder["name"])): group for group in groups.values()}
+                    for future in as_completed(futures):
+                        try:
+                            results = future.result()
+                        except Exception as e:
+                            results = [(file, e) for file in futures[future]]
+                        for file, error in results:
+                            if error is None:
+                                manifest[file] = folder["remote"][file]
+                                log.count("merged")
+                            else:
+                                failed.append(file)
+                                log.error("Failed to process file: {}".format(file), error, indent=3)
+                log.info("Merged {} files in {} seconds.".format(len(files), round(time.time() - start)), indent=2)
+                for file in folder["deleted"]:
+                    manifest.pop(file, None)
+        if executor is not None:
+            executor.shutdown()
+
+        with atomic_write(manifest_file, "w") as f:
+            json.dump(manifest, f)
+
+        log.info("Removing temporary data.")
         shutil.rmtree(temp)
-    os.makedirs(temp)
-
-    for folder in folders:
-        log.info("Downloading {} to {}".format(folder["name"], temp), indent=2)
-        start = time.process_time()
-        conn.get_r(remotedir=folder["name"], localdir=temp)
-        log.info("Downloaded {} in {} seconds.".format(folder["name"], round(time.process_time() - start)), indent=2)
-
-    conn.close()
-    log.info("Closing the connection to {}".format(ftp_host))
-
-    log.info("Processing downloaded data.")
-    failed = []
-    for folder in folders:
-        log.info("Processing data from {}".format(folder["name"]), indent=1)
-        if folder["operation"] == "overwrite":
-            log.info("Overwriting {} with new data.".format(os.path.join(parent, folder["name"])), indent=2)
-            if os.path.exists(os.path.join(parent, folder["name"])):
-                shutil.rmtree(os.path.join(parent, folder["name"]))
-            shutil.move(os.path.join(temp, folder["name"]), os.path.join(parent, folder["name"]))
-        elif folder["operation"] == "merge":
-            files = list_nested_dir(os.path.join(temp, folder["name"]))
-            log.info("Merging {} new files from {}.".format(len(files), folder["name"]), indent=2)
-            for file in files:
-                try:
-                    folder["process"](file, os.path.join(parent, folder["name"]))
-                except Exception as e:
-                    failed.append(file)
-                    log.error("Failed to process file: {}".format(file), e, indent=3)
-
-    log.info("Removing temporary data.")
-    shutil.rmtree(temp)
-
-    if len(failed) > 0:
-        raise ValueError("Failed to merge: {}".format(", ".join(failed)))
+        log.close()
+
+        if len(failed) > 0:
+            raise ValueError("Failed to merge: {}".format(", ".join(failed)))
@@ -0,0 +1,15 @@
+import sys
+import argparse
+from functions import convert_station_files
+
+
+if __name__ == "__main__":
+    if sys.version_info[0:2] != (3, 9):
+        raise Exception('Requires python 3.9')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folder', '-f', help="Root folder of the station csv files e.g. {{ filesystem path }}/dwd/meteodata", type=str)
+    parser.add_argument('--format', help="Output format [parquet]", type=str, default="parquet")
+    parser.add_argument('--remove', '-r', help="Remove the csv files once converted", action='store_true')
+    args = vars(parser.parse_args())
+    converted = convert_station_files(args["folder"], fmt=args["format"], remove=args["remove"])
+    print("Converted {} files".format(len(converted)))
@@ -2,17 +2,16 @@ import os
 import re
 import time
 import json
-import requests
 import numpy as np
 import pandas as pd
 import zipfile
-import tempfile
 from io import BytesIO
+from itertools import chain
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
-from functions import logger, parse_dict_string, split_date_range
+from functions import logger, parse_dict_string, split_date_range, merge_station_years, assemble_station_frame, fetcher, http_cache, backfill_checkpoint, watermarks
 
-def dwd_meteodata(data_folder):
+def dwd_meteodata(data_folder, workers=8, fmt="csv", backfill=None):
     """
     Download Meteodata from DWD
     https://opendata.dwd.de/
@@ -20,12 +19,12 @@ def dwd_meteodata(data_folder):
     Add new stations
     1. Find closest station https://alplakes-eawag.s3.eu-central-1.amazonaws.com/static/dwd/dwd_stations.json
     2. Add station to stations list
-    3. Set historical to True
+    3. Run a backfill of the historical record e.g. --backfill 2000-01-01 2025-01-01
     4. Upload data to API
     5. Edit FastAPI list of stations
-    """
 
-    historical = False
+    :param backfill: Tuple (start, end) of datetimes to backfill from the historical archive instead of fetching the recent files
+    """
 
     parameter_dict = {
         "air_temperature": {
@@ -63,7 +62,7 @@ def dwd_meteodata(data_folder):
     ]
     failed = []
 
-    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="dwd_meteodata")
     log.initialise("Download Meteodata from DWD")
 
     log.info("Ensure data folder exists.")
@@ -71,90 +70,163 @@ def dwd_meteodata(data_folder):
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    for station in stations:
-        log.info("Downloading data for station {}".format(station["id"]))
+    marks = watermarks(parent)
+    fetch = fetcher(workers=workers, cache=http_cache(os.path.join(parent, ".cache")) if backfill is None else None, metrics=log.metrics)
+    jobs = []
+    if backfill is None:
+        for station in stations:
+            for parameter in station["parameters"]:
+                jobs.append(((station["id"], parameter, "recent"), parameter_dict[parameter]["url"].format(int(station["id"]))))
+    else:
+        log.info("Backfilling data from {} to {}".format(backfill[0], backfill[1]))
+        checkpoint = backfill_checkpoint(parent, backfill[0], backfill[1])
+        for parameter in parameter_dict.keys():
+            url = parameter_dict[parameter]["url"].split("recent/")[0] + "historical"
+            response = fetch.get(url)
+            if response.status_code != 200:
+                raise ValueError("Status code not valid")
+            for line in response.text.splitlines():
+                for station in stations:
+                    if parameter in station["parameters"] and "10minutenwerte_" in line and "_{:05}_".format(int(station["id"])) in line:
+                        name = line.split('<a href="')[1].split('">')[0]
+                        dates = re.findall(r'_(\d{8})_(\d{8})_hist', name)
+                        if dates and (datetime.strptime(dates[0][1], "%Y%m%d") < backfill[0] or datetime.strptime(dates[0][0], "%Y%m%d") >= backfill[1]):
+                            continue
+                        jobs.append(((station["id"], parameter, name), url + "/" + name))
+        if backfill[1] > datetime.now() - timedelta(days=550):
+            for station in stations:
+                for parameter in station["parameters"]:
+                    jobs.append(((station["id"], parameter, "recent"), parameter_dict[parameter]["url"].format(int(station["id"]))))
+        jobs = [job for job in jobs if not checkpoint.done(job[0][0], "{}/{}".format(job[0][1], job[0][2]))]
 
-        data = {parameter: False for parameter in station["parameters"]}
+    urls = dict(jobs)
+    data = {station["id"]: {parameter: [] for parameter in station["parameters"]} for station in stations}
+    pending = {station["id"]: 0 for station in stations}
+    for job in jobs:
+        pending[job[0][0]] += 1
 
-        if historical:
-            log.info("Accessing complete historical record")
+    log.info("Downloading {} files for {} stations".format(len(jobs), len(stations)))
+    completed = [((station["id"], None, None), None) for station in stations if pending[station["id"]] == 0]
+    for (station_id, parameter, name), response in chain(completed, fetch.map(jobs)):
+        if parameter is not None:
+            pending[station_id] -= 1
+            try:
+                if isinstance(response, Exception) or response.status_code not in [200, 304]:
+                    raise ValueError("Status code not valid")
+                if backfill is None:
+                    # Unchanged files are read from the cache once the station is complete, unless all are unchanged
+                    data[station_id][parameter].append(response.content if response.status_code == 200 else None)
+                else:
+                    with log.timer("parse"):
+                        df = read_zip(response.content, parameter_dict[parameter]["parameters"])
+                    df = df[(df["time"] >= pd.Timestamp(backfill[0], tz="UTC")) & (df["time"] < pd.Timestamp(backfill[1], tz="UTC"))]
+                    checkpoint.stage(station_id, "{}/{}".format(parameter, name), df)
+            except:
+                log.info("FAILED {} ({})".format(station_id, parameter), indent=1)
+                if fetch.cache is not None:
+                    fetch.cache.remove(urls[(station_id, parameter, name)])
+                if station_id not in failed:
+                    failed.append(station_id)
 
-            for parameter in station["parameters"]:
-                url = parameter_dict[parameter]["url"].split("recent/")[0] + "historical"
-                response = requests.get(url)
-                if response.status_code == 200:
-                    for line in response.text.splitlines():
-                        if "10minutenwerte_" in line and "_{:05}_".format(int(station["id"])) in line:
-                            zip_url = url + "/" + line.split('<a href="')[1].split('">')[0]
-                            response = requests.get(zip_url)
-                            if response.status_code == 200:
-                                with zipfile.ZipFile(BytesIO(response.content), 'r') as zip_ref:
-                                    with tempfile.TemporaryDirectory() as temp_dir:
-                                        zip_ref.extractall(temp_dir)
-                                        text_files = [f for f in zip_ref.namelist() if f.endswith(".txt")]
-                                        if text_files:
-                                            text_file_path = f"{temp_dir}/{text_files[0]}"
-                                            df = pd.read_csv(text_file_path, delimiter=";")
-                                            df["time"] = pd.to_datetime(df['MESS_DATUM'], format='%Y%m%d%H%M', utc=True)
-                                            df = df[["time"] + parameter_dict[parameter]["parameters"]]
-                                            df.replace(-999, np.nan, inplace=True)
-                                            if isinstance(data[parameter], pd.DataFrame):
-                                                merged_df = pd.concat([data[parameter], df])
-                                                data[parameter] = merged_df.sort_values(by='time')
-                                            else:
-                                                data[parameter] = df
-                                        else:
-                                            raise ValueError("Text file not found")
-                            else:
-                                raise ValueError("Status code not valid")
+        if pending[station_id] > 0 or station_id in failed:
+            continue
+        if backfill is not None:
+            if checkpoint.finished(station_id):
+                continue
+            for key, df in checkpoint.load(station_id):
+                data[station_id][key.split("/")[0]].append(df)
 
-        try:
-            for parameter in station["parameters"]:
-                zip_url = parameter_dict[parameter]["url"].format(int(station["id"]))
-                response = requests.get(zip_url)
-                if response.status_code == 200:
-                    with zipfile.ZipFile(BytesIO(response.content), 'r') as zip_ref:
-                        with tempfile.TemporaryDirectory() as temp_dir:
-                            zip_ref.extractall(temp_dir)
-                            text_files = [f for f in zip_ref.namelist() if f.endswith(".txt")]
-                            if text_files:
-                                text_file_path = f"{temp_dir}/{text_files[0]}"
-                                df = pd.read_csv(text_file_path, delimiter=";")
-                                df["time"] = pd.to_datetime(df['MESS_DATUM'], format='%Y%m%d%H%M', utc=True)
-                                df = df[["time"] + parameter_dict[parameter]["parameters"]]
-                                df.replace(-999, np.nan, inplace=True)
-                                if isinstance(data[parameter], pd.DataFrame):
-                                    merged_df = pd.concat([data[parameter], df])
-                                    data[parameter] = merged_df.sort_values(by='time')
-                                else:
-                                    data[parameter] = df
-                            else:
-                                raise ValueError("Text file not found")
-                else:
-                    raise ValueError("Status code not valid")
+        station = next(s for s in stations if s["id"] == station_id)
+        if backfill is None:
+            start = marks.start(station_id, list(chain.from_iterable(parameter_dict[p]["parameters"] for p in station["parameters"])), None)
+            if start is not None and all(content is None for p in station["parameters"] for content in data[station_id][p]):
+                log.info("Not modified {}".format(station_id), indent=1)
+                data[station_id] = None
+                continue
 
-            df = data[station["parameters"][0]]
-            for key in station["parameters"][1:]:
-                df = pd.merge(df, data[key], on='time', how='outer')
-
-            for year in range(df['time'].min().year, df['time'].max().year + 1):
-                station_year_file = os.path.join(parent, station["id"], "{}.csv".format(year))
-                station_year_data = df[df['time'].dt.year == year]
-                if not os.path.exists(station_year_file):
-                    log.info("Saving file new file {}.".format(station_year_file), indent=1)
-                    os.makedirs(os.path.dirname(station_year_file), exist_ok=True)
-                    station_year_data.to_csv(station_year_file, index=False)
-                else:
-                    df_existing = pd.read_csv(station_year_file)
-                    df_existing['time'] = pd.to_datetime(df_existing['time'])
-                    combined = pd.concat([df_existing, station_year_data])
-                    combined = combined.drop_duplicates(subset=['time'], keep='last')
-                    combined = combined.sort_values(by='time')
-                    combined.to_csv(station_year_file, index=False)
+        log.info("Processing data for station {}".format(station_id))
+        try:
+            if backfill is None:
+                for p in station["parameters"]:
+                    content = data[station_id][p][0]
+                    if content is None:
+                        content = fetch.cache.load(urls[(station_id, p, "recent")])
+                    with log.timer("parse"):
+                        df = read_zip(content, parameter_dict[p]["parameters"])
+                    if start is not None:
+                        df = df[df["time"] >= pd.Timestamp(start, tz="UTC")]
+                    data[station_id][p] = [df]
+            dfs = [pd.concat(data[station_id][p]) for p in station["parameters"] if len(data[station_id][p]) > 0]
+            if len(dfs) > 0:
+                with log.timer("assemble"):
+                    df = assemble_station_frame(dfs)
+                merge_station_years(os.path.join(parent, station["id"]), df, fmt=fmt, log=log)
+                marks.update(station_id, df)
+            else:
+                log.info("No data available for station {}".format(station_id), indent=1)
+            if backfill is not None:
+                checkpoint.complete(station_id)
         except:
             log.info("FAILED", indent=1)
-            if station["id"] not in failed:
-                failed.append(station["id"])
+            if fetch.cache is not None:
+                for key in urls:
+                    if key[0] == station_id:
+                        fetch.cache.remove(urls[key])
+            if station_id not in failed:
+                failed.append(station_id)
+        data[station_id] = None
+
+    fetch.close()
+    marks.save()
+    if fetch.cache is not None:
+        log.info("HTTP cache: {} hits, {} misses".format(fetch.cache.hits, fetch.cache.misses))
+        log.count("cache_hits", fetch.cache.hits)
+        log.count("cache_misses", fetch.cache.misses)
+    log.close()
+
+    if backfill is not None and len(failed) == 0:
+        checkpoint.finish()
 
     if len(failed) > 0:
         raise ValueError("Failed to download at least one time period from: {}".format(", ".join(failed)))
+
+
+def read_zip(content, parameters):
+    """
+    Read the parameters from a DWD product zip file.
+
+    The product file is parsed straight from the zip member, only the time and the requested columns are read and the
+    -999 fill values are converted to NaN while parsing.
+
+    :param content: Bytes of the zip file
+    :param parameters: List of DWD parameter names e.g. ["TT_10", "RF_10"]
+    :return: DataFrame with a UTC time column and one float column per parameter
+    """
+    with zipfile.ZipFile(BytesIO(content), 'r') as zip_ref:
+        text_files = [f for f in zip_ref.namelist() if f.endswith(".txt")]
+        if not text_files:
+            raise ValueError("Text file not found")
+        text_file = next((f for f in text_files if os.path.basename(f).startswith("produkt")), text_files[0])
+        with zip_ref.open(text_file) as f:
+            columns = f.readline().decode("latin-1").strip().split(";")
+            names = {c.strip(): c for c in columns}
+            missing = [p for p in ["MESS_DATUM"] + parameters if p not in names]
+            if missing:
+                raise ValueError("Columns {} not found in {}".format(", ".join(missing), text_file))
+            dtype = {names[p]: np.float64 for p in parameters}
+            dtype[names["MESS_DATUM"]] = np.int64
+            df = pd.read_csv(f, sep=";", header=None, names=columns, usecols=list(dtype.keys()), dtype=dtype,
+                             skipinitialspace=True, na_values=["-999"], keep_default_na=False, encoding="latin-1")
+    df.columns = [c.strip() for c in df.columns]
+    df.insert(0, "time", parse_time(df.pop("MESS_DATUM").to_numpy()))
+    return df[["time"] + parameters]
+
+
+def parse_time(values):
+    """
+    Convert DWD integer timestamps (YYYYMMDDHHMM) to UTC datetimes without going through strings.
+    """
+    values = values.astype(np.int64)
+    days = ((values // 100000000 - 1970).astype("datetime64[Y]") + (values // 1000000 % 100 - 1).astype("timedelta64[M]")).astype("datetime64[D]")
+    times = days + (values // 10000 % 100 - 1).astype("timedelta64[D]") + (values // 100 % 100).astype("timedelta64[h]") + (values % 100).astype("timedelta64[m]")
+    return pd.to_datetime(times.astype("datetime64[ns]")).tz_localize("UTC")
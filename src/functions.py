@@ -1,16 +1,32 @@
+import io
 import os
 import re
+import csv
 import sys
-import glob
+import json
 import math
+import atexit
+import time
+import random
 import shutil
-import xarray
-import zipfile
+import hashlib
 import logging
+import tempfile
+import requests
+import threading
 import traceback
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from dateutil.relativedelta import relativedelta
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def list_nested_dir(root):
     f = []
@@ -32,35 +48,6 @@ def progressbar(x, y):
     sys.stdout.flush()
 
 
-def unzip_combine(path):
-    if ".zip" in path:
-        temp_folder = path.replace(".zip", "")
-        if os.path.exists(temp_folder):
-            shutil.rmtree(temp_folder)
-        os.makedirs(temp_folder)
-        try:
-            with zipfile.ZipFile(path, 'r') as zip_ref:
-                zip_ref.extractall(temp_folder)
-
-            nc_files = sorted(glob.glob(os.path.join(temp_folder, '*.nc')))
-            if not nc_files:
-                raise ValueError(f"No NetCDF files found in {temp_folder}")
-
-            datasets = (xarray.open_dataset(f) for f in nc_files)
-            ds = xarray.concat(datasets, dim='time')
-            ds.to_netcdf(path.replace(".zip", ".nc"))
-            ds.close()
-            shutil.rmtree(temp_folder)
-            os.unlink(path)
-        except:
-            shutil.rmtree(temp_folder)
-            if os.path.exists(path.replace(".zip", ".nc")):
-                os.unlink(path.replace(".zip", ".nc"))
-            raise ValueError("Failed to unzip and combine {}".format(path))
-    else:
-        raise ValueError("Path is not a zip file: {}".format(path))
-
-
 def split_date_range(start_date, end_date, period, unit='days'):
     """
     Splits a date range into chunks of a given period.
@@ -95,48 +82,156 @@ def split_date_range(start_date, end_date, period, unit='days'):
     return chunks
 
 
+class metrics(object):
+    """
+    Wall time of the stages of a run and counters, safe to update from several threads.
+
+    Stage times are summed over all the calls of a stage, stages running on several threads at once (e.g. download)
+    can add up to more than the duration of the run.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            total = self.stages.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, source):
+        """
+        :return: Dictionary with the source, start, end, duration, stages {stage: {"seconds", "calls"}} and counters
+        """
+        with self.lock:
+            end = time.time()
+            return {"source": source, "start": datetime.utcfromtimestamp(self.start).isoformat() + "Z",
+                    "end": datetime.utcfromtimestamp(end).isoformat() + "Z", "duration": round(end - self.start, 3),
+                    "stages": {k: {"seconds": round(v[0], 3), "calls": v[1]} for k, v in self.stages.items()},
+                    "counters": dict(self.counters)}
+
+    def write_jsonl(self, path, source):
+        """
+        Append the record of the run to a JSON lines file.
+        """
+        with open(path, "a") as f:
+            f.write(json.dumps(self.record(source)) + "\n")
+
+    def write_prometheus(self, path, source):
+        """
+        Write the metrics of the run to a Prometheus textfile (e.g. for the node exporter textfile collector).
+        """
+        record = self.record(source)
+        label = 'source="{}"'.format(source)
+        lines = ["# HELP alplakes_run_duration_seconds Duration of the last run",
+                 "# TYPE alplakes_run_duration_seconds gauge",
+                 "alplakes_run_duration_seconds{{{}}} {}".format(label, record["duration"]),
+                 "# HELP alplakes_run_end_timestamp_seconds End time of the last run",
+                 "# TYPE alplakes_run_end_timestamp_seconds gauge",
+                 "alplakes_run_end_timestamp_seconds{{{}}} {}".format(label, round(time.time(), 3)),
+                 "# HELP alplakes_stage_seconds Time spent in each stage of the last run, summed over threads",
+                 "# TYPE alplakes_stage_seconds gauge"]
+        lines += ['alplakes_stage_seconds{{{},stage="{}"}} {}'.format(label, k, v["seconds"]) for k, v in record["stages"].items()]
+        lines += ["# HELP alplakes_stage_calls Number of calls of each stage in the last run",
+                  "# TYPE alplakes_stage_calls gauge"]
+        lines += ['alplakes_stage_calls{{{},stage="{}"}} {}'.format(label, k, v["calls"]) for k, v in record["stages"].items()]
+        for name, value in record["counters"].items():
+            lines += ["# TYPE alplakes_{}_last_run gauge".format(name),
+                      "alplakes_{}_last_run{{{}}} {}".format(name, label, value)]
+        with atomic_write(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+
 class logger(object):
-    def __init__(self, name, path="logs"):
+    """
+    Log to the console and to {path}/{name}_{time}.txt.
+
+    The log file is kept open with a buffered handle and flushed on warnings, errors and at the end of the run.
+    Stage times and counters are collected in self.metrics with timer() and count(). When the logger is closed, or at
+    exit, they are appended to {path}/metrics.jsonl and, if logger.textfile is set to a folder, written to
+    {textfile}/alplakes_{source}.prom for Prometheus. Setting logger.root to a folder replaces the path of every logger,
+    e.g. to keep the logs and metrics of benchmark runs apart.
+    """
+    textfile = None
+    root = None
+
+    def __init__(self, name, path="logs", source=None):
+        if logger.root:
+            path = logger.root
         self.name = name + datetime.now().strftime("_%Y%m%d_%H%M%S") + ".txt"
+        self.folder = path
         self.path = os.path.join(path, self.name)
+        self.source = source if source else name
         self.stage = 1
         if not os.path.exists(path):
             os.makedirs(path)
+        self.file = open(self.path, "a")
+        self.lock = threading.Lock()
+        self.metrics = metrics()
+        self.closed = False
+        atexit.register(self.close)
+
+    def write(self, string, flush=False):
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(string + "\n")
+            if flush:
+                self.file.flush()
+
+    def timer(self, stage):
+        return self.metrics.timer(stage)
+
+    def count(self, name, value=1):
+        self.metrics.count(name, value)
 
     def info(self, string, indent=0):
         logging.info(string)
         out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + string
         print(out)
-        with open(self.path, "a") as file:
-            file.write(out + "\n")
+        self.write(out)
 
     def initialise(self, string):
         out = "****** " + string + " ******"
         print('\033[1m' + out + '\033[0m')
-        with open(self.path, "a") as file:
-            file.write(out + "\n")
+        self.write(out, flush=True)
 
     def warning(self, string, indent=0):
         logging.warning(string)
         out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + "WARNING: " + string
         print('\033[93m' + out + '\033[0m')
-        with open(self.path, "a") as file:
-            file.write(out + "\n")
+        self.count("warnings")
+        self.write(out, flush=True)
 
     def error(self, string, error, indent=0):
         out = datetime.now().strftime("%H:%M:%S.%f") + (" " * 3 * (indent + 1)) + "ERROR: " + string
         print('\033[91m' + out + '\033[0m')
         print(error)
-        with open(self.path, "a") as file:
-            file.write(out + "\n")
-            file.write("\n")
-            traceback.print_exc(file=file)
+        self.count("errors")
+        with self.lock:
+            if not self.closed:
+                self.file.write(out + "\n\n")
+                traceback.print_exc(file=self.file)
+                self.file.flush()
 
     def end(self, string):
         out = "****** " + string + " ******"
         print('\033[92m' + out + '\033[0m')
-        with open(self.path, "a") as file:
-            file.write(out + "\n")
+        self.write(out, flush=True)
 
     def subprocess(self, process, error=""):
         failed = False
@@ -146,22 +241,347 @@ class logger(object):
             print(out)
             if error != "" and error in out:
                 failed = True
-            with open(self.path, "a") as file:
-                file.write(out + "\n")
+            self.write(out)
             return_code = process.poll()
             if return_code is not None:
                 for output in process.stdout.readlines():
                     out = output.strip()
                     print(out)
-                    with open(self.path, "a") as file:
-                        file.write(out + "\n")
+                    self.write(out)
                 break
         return failed
 
     def newline(self):
         print("")
-        with open(self.path, "a") as file:
-            file.write("\n")
+        self.write("")
+
+    def close(self):
+        """
+        Export the metrics of the run and close the log file.
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.file.close()
+        atexit.unregister(self.close)
+        try:
+            self.metrics.write_jsonl(os.path.join(self.folder, "metrics.jsonl"), self.source)
+            if logger.textfile:
+                os.makedirs(logger.textfile, exist_ok=True)
+                self.metrics.write_prometheus(os.path.join(logger.textfile, "alplakes_{}.prom".format(self.source)), self.source)
+        except Exception as e:
+            print("Failed to write metrics: {}".format(e))
+
+
+class token_bucket(object):
+    """
+    Token bucket limiting the rate of requests to a host.
+
+    With rate=None requests are not throttled but pauses still apply, e.g. after a 429 response all the requests to
+    the host wait for the Retry-After delay.
+    """
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a request can be made.
+
+        :return: Seconds waited
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused - now
+                if wait <= 0:
+                    if self.rate is None:
+                        return waited
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused = max(self.paused, time.monotonic() + seconds)
+
+
+class fetcher(object):
+    """
+    Concurrent HTTP downloads over a pooled keep-alive session.
+
+    Requests run on a bounded pool of worker threads with a limit on the number of simultaneous requests per host and
+    an optional rate limit per host (token bucket). Every request has a connect and read timeout. Connection errors,
+    timeouts and 429/5xx responses are retried with jittered exponential backoff, a Retry-After header sets the delay
+    and pauses all the requests to the host. Responses are handed back to the calling thread as they complete so that
+    processing and writing stays serial.
+    """
+    retry_status = [429, 500, 502, 503, 504]
+    retry_errors = (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)
+
+    def __init__(self, workers=8, host_limit=4, headers=None, cache=None, metrics=None, timeout=(10, 60), retries=3,
+                 backoff=1.0, max_delay=300, rate=None, burst=1):
+        """
+        :param workers: Number of concurrent requests
+        :param host_limit: Maximum number of simultaneous requests per host
+        :param headers: Headers added to every request
+        :param cache: http_cache for conditional requests
+        :param metrics: metrics object recording downloads and retries
+        :param timeout: Default (connect, read) timeout in seconds
+        :param retries: Number of retries of a failed request
+        :param backoff: Base delay in seconds, the delay before retry n is drawn between backoff * 2^n / 2 and backoff * 2^n
+        :param max_delay: Maximum delay in seconds before a retry, including Retry-After
+        :param rate: Maximum number of requests per second per host, None for no limit
+        :param burst: Number of requests per host that can be made at once before the rate applies
+        """
+        self.workers = workers
+        self.cache = cache
+        self.metrics = metrics
+        self.host_limit = host_limit
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.rate = rate
+        self.burst = burst
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if headers:
+            self.session.headers.update(headers)
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, url):
+        """
+        :return: Tuple (semaphore, token bucket) of the host of the url
+        """
+        netloc = urlparse(url).netloc
+        with self.lock:
+            if netloc not in self.hosts:
+                self.hosts[netloc] = (threading.BoundedSemaphore(self.host_limit), token_bucket(self.rate, self.burst))
+            return self.hosts[netloc]
+
+    def get(self, url, **kwargs):
+        if self.cache is not None:
+            kwargs["headers"] = dict(kwargs.get("headers") or {}, **self.cache.headers(url))
+        response = self.request("GET", url, **kwargs)
+        if self.cache is not None:
+            self.cache.update(url, response)
+        return response
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request, retrying connection errors, timeouts and 429/5xx responses.
+
+        :return: Response, the last response if all the attempts returned a status that is retried
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        semaphore, bucket = self.host(url)
+        for attempt in range(self.retries + 1):
+            response, error = None, None
+            with semaphore:
+                waited = bucket.acquire()
+                if waited > 0 and self.metrics is not None:
+                    self.metrics.add_time("throttle", waited)
+                start = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except self.retry_errors as e:
+                    error = e
+                self.measure(start, response)
+            if error is None and response.status_code not in self.retry_status:
+                return response
+            if attempt == self.retries:
+                if error is not None:
+                    raise error
+                return response
+            delay = self.delay(attempt, response)
+            if response is not None:
+                if response.status_code == 429 or "Retry-After" in response.headers:
+                    bucket.pause(delay)
+                response.close()
+            if self.metrics is not None:
+                self.metrics.count("retries")
+            time.sleep(delay)
+
+    def delay(self, attempt, response=None):
+        """
+        Delay before a retry: the Retry-After header of the response if set, otherwise jittered exponential backoff.
+        """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(self.max_delay, max(0.0, float(retry_after)))
+            except ValueError:
+                try:
+                    return min(self.max_delay, max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()))
+                except (TypeError, ValueError):
+                    pass
+        delay = min(self.max_delay, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def measure(self, start, response):
+        if self.metrics is not None:
+            self.metrics.add_time("download", time.perf_counter() - start)
+            self.metrics.count("requests")
+            if response is not None:
+                self.metrics.count("bytes", len(response.content))
+
+    def map(self, jobs, **kwargs):
+        """
+        Download urls concurrently.
+
+        :param jobs: Iterable of tuples (key, url)
+        :param kwargs: Keyword arguments passed to every request
+        :return: Generator of tuples (key, response) in order of completion, response is the exception if the request failed
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.get, url, **kwargs): key for key, url in jobs}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+
+    def close(self):
+        self.session.close()
+        if self.cache is not None:
+            self.cache.save()
+
+
+class http_cache(object):
+    """
+    On-disk cache of HTTP responses validated with ETag and Last-Modified.
+
+    Requests for cached urls are sent with If-None-Match and If-Modified-Since, a 304 Not Modified response means the
+    file is unchanged since it was last downloaded. Response bodies are kept in the cache folder so they can be reused
+    when needed, the least recently used entries are evicted once the cache grows above max_size bytes.
+    """
+    def __init__(self, folder, max_size=1024 ** 3):
+        self.folder = folder
+        self.max_size = max_size
+        self.path = os.path.join(folder, "index.json")
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries = {}
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                self.entries = {}
+        self.entries = {url: e for url, e in self.entries.items() if os.path.exists(self.file(url))}
+        self.sweep()
+
+    def file(self, url):
+        return os.path.join(self.folder, hashlib.sha1(url.encode()).hexdigest())
+
+    def sweep(self, age=timedelta(days=1)):
+        """
+        Remove the response bodies that no entry refers to and the temporary files of bodies, left by a run that
+        stopped before saving the index.
+
+        Only files older than age are removed, the temporary files and new bodies of a run that is still going are
+        left alone.
+        """
+        known = set(os.path.basename(self.file(url)) for url in self.entries)
+        for file in os.listdir(self.folder):
+            path = os.path.join(self.folder, file)
+            if file in known or not re.fullmatch(r"[0-9a-f]{40}|\.[0-9a-f]{40}\..*\.tmp", file):
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > age.total_seconds():
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def headers(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def update(self, url, response):
+        """
+        Record a response, counting 304 responses as hits and storing the body of 200 responses with a validator.
+        """
+        if response.status_code == 304:
+            with self.lock:
+                self.hits += 1
+                if url in self.entries:
+                    self.entries[url]["used"] = time.time()
+            return
+        with self.lock:
+            self.misses += 1
+        if response.status_code != 200:
+            return
+        etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        file = self.file(url)
+        with atomic_write(file) as f:
+            f.write(response.content)
+        with self.lock:
+            self.entries[url] = {"etag": etag, "last_modified": last_modified, "size": len(response.content),
+                                 "used": time.time()}
+            self.evict()
+
+    def load(self, url):
+        """
+        Body of a cached response.
+
+        :param url: Url of the cached response
+        :return: bytes
+        """
+        with open(self.file(url), "rb") as f:
+            return f.read()
+
+    def remove(self, url):
+        """
+        Forget a cached response, e.g. when the download could not be processed and has to be fetched again.
+        """
+        with self.lock:
+            self.entries.pop(url, None)
+        if os.path.exists(self.file(url)):
+            os.remove(self.file(url))
+
+    def evict(self):
+        size = sum(e["size"] for e in self.entries.values())
+        for url in sorted(self.entries, key=lambda u: self.entries[u]["used"]):
+            if size <= self.max_size:
+                break
+            size -= self.entries.pop(url)["size"]
+            if os.path.exists(self.file(url)):
+                os.remove(self.file(url))
+
+    def save(self):
+        with self.lock:
+            with atomic_write(self.path, "w") as f:
+                json.dump(self.entries, f, indent=1)
 
 
 def split_string(s):
@@ -215,4 +635,697 @@ def parse_list_string(data):
     return list
 
 def merge_dfs(left, right):
-    return pd.merge(left, right, on='time', how='outer')
\ No newline at end of file
+    return pd.merge(left, right, on='time', how='outer')
+
+
+def assemble_station_frame(frames, time="time", keep="last"):
+    """
+    Combine per-parameter frames of a station into one wide frame aligned on time.
+
+    The time axes are joined once into a union index and the columns of each frame are scattered into it, frames that
+    are already on the union time axis are used without copying. This replaces one outer merge (copy and sort) per frame.
+    The frames should not share parameter columns.
+
+    :param frames: List of DataFrames with a time column and one or more parameter columns
+    :param time: Name of the time column
+    :param keep: Which row to keep when a frame has duplicate times
+    :return: DataFrame with the time column and the parameter columns of all frames, sorted by time
+    """
+    frames = list(frames)
+    if len(frames) == 0:
+        return pd.DataFrame(columns=[time])
+    keys = []
+    for i, df in enumerate(frames):
+        key = pd.Index(df[time])
+        if not key.is_monotonic_increasing or not key.is_unique:
+            df = df.drop_duplicates(subset=[time], keep=keep).sort_values(by=time)
+            frames[i], key = df, pd.Index(df[time])
+        keys.append(key)
+    index = keys[0]
+    positions = [None]
+    for key in keys[1:]:
+        if key.equals(index):
+            positions.append(None)
+            continue
+        index, left, right = index.join(key, how="outer", return_indexers=True)
+        if left is not None:
+            moved = np.flatnonzero(left >= 0)
+            positions = [moved if p is None else moved[p] for p in positions]
+        positions.append(None if right is None else np.flatnonzero(right >= 0))
+    columns = {time: index}
+    for df, position in zip(frames, positions):
+        for column in df.columns:
+            if column == time:
+                continue
+            values = df[column].to_numpy()
+            if position is None:
+                columns[column] = values
+            else:
+                if values.dtype.kind in "iub":
+                    values = values.astype(np.float64)
+                out = np.full(len(index), np.nan if values.dtype.kind in "fc" else None, dtype=values.dtype if values.dtype.kind in "fcO" else object)
+                out[position] = values
+                columns[column] = out
+    return pd.DataFrame(columns)
+
+@contextmanager
+def atomic_write(path, mode="wb", permissions=None):
+    """
+    Write a file atomically.
+
+    The data is written to a temporary file in the same folder, flushed to disk and renamed over the destination, so
+    readers and interrupted runs only ever see the previous or the complete new file.
+
+    :param path: Destination file
+    :param mode: File mode, "wb" or "w"
+    :param permissions: Permissions of the file e.g. 0o600, defaults to the permissions of the existing file or 0o644.
+        The temporary file is only readable by the user until then.
+    :return: Context manager yielding the open temporary file
+    """
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    fd, temp = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(path)), suffix=".tmp", dir=folder)
+    try:
+        with os.fdopen(fd, mode, **({} if "b" in mode else {"newline": "", "encoding": "utf-8"})) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if permissions is not None:
+            os.chmod(temp, permissions)
+        elif os.path.exists(path):
+            os.chmod(temp, os.stat(path).st_mode & 0o777)
+        else:
+            os.chmod(temp, 0o644)
+        os.replace(temp, path)
+        _fsync_folder(folder)
+    except BaseException:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+
+def write_if_changed(path, data):
+    """
+    Atomically write bytes to a file unless the file already has exactly this content.
+
+    :param path: Destination file
+    :param data: Bytes to write
+    :return: True if the file was written
+    """
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, "rb") as f:
+            if hashlib.sha1(f.read()).digest() == hashlib.sha1(data).digest():
+                return False
+    with atomic_write(path) as f:
+        f.write(data)
+    return True
+
+
+def _fsync_folder(folder):
+    try:
+        fd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def rewrite_tail(path, offset, data, block=1048576):
+    """
+    Atomically replace everything after a byte offset of a file.
+
+    :param path: File to rewrite
+    :param offset: Number of bytes to keep from the start of the file
+    :param data: Bytes written after the kept part
+    """
+    with open(path, "rb") as src, atomic_write(path) as dst:
+        remaining = offset
+        while remaining > 0:
+            chunk = src.read(min(block, remaining))
+            if not chunk:
+                break
+            dst.write(chunk)
+            remaining -= len(chunk)
+        dst.write(data)
+
+
+def replace_folder(src, dst):
+    """
+    Replace a folder with another one.
+
+    The old folder is renamed out of the way before the new one is renamed into place, the window in which dst does
+    not exist is limited to two renames. A folder left behind by an interrupted swap is restored on the next call.
+
+    :param src: Folder with the new content, on the same filesystem as dst
+    :param dst: Folder to replace
+    """
+    dst = os.path.normpath(dst)
+    old = os.path.join(os.path.dirname(dst), ".{}.old".format(os.path.basename(dst)))
+    if os.path.exists(old):
+        if os.path.exists(dst):
+            shutil.rmtree(old)
+        else:
+            os.rename(old, dst)
+    if os.path.exists(dst):
+        os.rename(dst, old)
+    os.rename(src, dst)
+    _fsync_folder(os.path.dirname(os.path.abspath(dst)))
+    if os.path.exists(old):
+        shutil.rmtree(old)
+
+
+def state_path(path, suffix, state=None):
+    """
+    Path of a state file (lock, index) of a data file.
+
+    State files are kept in a .state folder at the root of the data tree, mirroring the layout of the tree, so that
+    the station folders only contain data files.
+
+    :param path: Data file
+    :param suffix: Suffix of the state file e.g. ".lock"
+    :param state: Root of the data tree, defaults to the parent of the folder of the file e.g. the source folder for
+        {source}/{station}/{year}.csv
+    :return: Path of the state file
+    """
+    path = os.path.abspath(path)
+    if state is None:
+        state = os.path.dirname(os.path.dirname(path))
+    state = os.path.abspath(state)
+    return os.path.join(state, ".state", os.path.relpath(path, state) + suffix)
+
+
+@contextmanager
+def file_lock(path, blocking=True, state=None):
+    """
+    Advisory exclusive lock on a file, held in a .lock file in the state folder of the data tree (see state_path).
+
+    Runs of different sources, or overlapping runs of the same source, take the lock before modifying a station file
+    so that concurrent read-modify-write cycles cannot interleave. Locking is skipped where fcntl is not available.
+
+    :param path: File to lock
+    :param blocking: Wait for the lock, otherwise raise BlockingIOError if it is held
+    :param state: Root of the data tree
+    """
+    if fcntl is None:
+        yield
+        return
+    lock = state_path(path, ".lock", state)
+    os.makedirs(os.path.dirname(lock), exist_ok=True)
+    with open(lock, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _index_path(path, state=None):
+    return state_path(path, ".index.json", state)
+
+
+def _key_parser(series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return pd.Timestamp
+    return float
+
+
+def _line_key(line, position):
+    return next(csv.reader([line.decode("utf-8")]))[position]
+
+
+def _edge_lines(path):
+    """
+    Read the header, first and last data lines of a csv file without parsing the rest of it.
+    """
+    with open(path, "rb") as f:
+        header = f.readline()
+        first = f.readline()
+        end = f.seek(0, os.SEEK_END)
+        window = 4096
+        while True:
+            start = max(len(header), end - window)
+            f.seek(start)
+            lines = f.read(end - start).rstrip(b"\n").split(b"\n")
+            if len(lines) > 1 or start == len(header):
+                break
+            window = window * 4
+    return header, first.rstrip(b"\n"), lines[-1]
+
+
+def _count_rows(path):
+    rows = 0
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1048576), b""):
+            rows += block.count(b"\n")
+    return rows - 1
+
+
+def read_index(path, state=None):
+    """
+    Read the sidecar index of a station file.
+
+    :param path: Path to the station file
+    :param state: Root of the data tree
+    :return: Index dictionary or None if the index is missing or out of date with the file
+    """
+    try:
+        with open(_index_path(path, state), "r") as f:
+            index = json.load(f)
+        stat = os.stat(path)
+        if index["size"] != stat.st_size or index["mtime"] != stat.st_mtime_ns:
+            return None
+        return index
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_index(path, time, rows=None, state=None):
+    """
+    Write the sidecar index (columns, min/max time, row count) of a station file.
+
+    :param path: Path to the station file
+    :param time: Name of the time column
+    :param rows: Number of data rows, counted from the file if not provided
+    :param state: Root of the data tree
+    :return: Index dictionary
+    """
+    header, first, last = _edge_lines(path)
+    columns = next(csv.reader([header.decode("utf-8")]))
+    index = {"columns": columns, "time": time, "min": None, "max": None, "rows": 0}
+    if first and time in columns:
+        position = columns.index(time)
+        index["min"] = _line_key(first, position)
+        index["max"] = _line_key(last, position)
+        index["rows"] = _count_rows(path) if rows is None else int(rows)
+    stat = os.stat(path)
+    index["size"] = stat.st_size
+    index["mtime"] = stat.st_mtime_ns
+    with atomic_write(_index_path(path, state), "w") as f:
+        json.dump(index, f)
+    return index
+
+
+def _tail_offset(path, header_size, position, parse, start, block=65536):
+    """
+    Locate the tail of a sorted csv file containing all the rows with a time >= start.
+
+    :return: Tuple (byte offset of the tail, number of rows in the tail)
+    """
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        window = block
+        while True:
+            window_start = max(header_size, end - window)
+            f.seek(window_start)
+            data = f.read(end - window_start)
+            lines = data.split(b"\n")[:-1]
+            if window_start > header_size:
+                window_start += len(lines[0]) + 1
+                lines = lines[1:]
+            offset = end
+            for i in range(len(lines) - 1, -1, -1):
+                if parse(_line_key(lines[i], position)) < start:
+                    return offset, len(lines) - 1 - i
+                offset -= len(lines[i]) + 1
+            if window_start == header_size:
+                return header_size, len(lines)
+            window = window * 4
+
+
+def _read_frame(data, time, like):
+    df = pd.read_csv(io.BytesIO(data))
+    if pd.api.types.is_datetime64_any_dtype(like):
+        df[time] = pd.to_datetime(df[time])
+    return df
+
+
+def merge_station_year(path, df, time="time", keep="last", fill=None, state=None):
+    """
+    Merge new rows into a station year file.
+
+    Rows after the last timestamp of the file are appended. Overlapping rows are merged by rewriting the file from the
+    first overlapping timestamp onwards. Files are always replaced atomically under an advisory lock. A sidecar index
+    (columns, min/max time, row count) is kept in the state folder so that most merges never parse the existing data.
+    Paths ending in .parquet are merged with merge_station_year_parquet.
+
+    :param path: Path to the station year file (.csv or .parquet)
+    :param df: DataFrame of new data
+    :param time: Name of the time column used to deduplicate and sort the rows
+    :param keep: Which duplicate to keep, "last" prefers the new data and "first" the existing data
+    :param fill: Value used to fill missing data
+    :param state: Root of the data tree holding the lock and index files, see state_path
+    :return: Operation performed ("new", "append" or "merge"), None if there was no data
+    """
+    with file_lock(path, state=state):
+        if path.endswith(".parquet"):
+            return merge_station_year_parquet(path, df, time=time, keep=keep, fill=fill)
+        return _merge_station_year_csv(path, df, time=time, keep=keep, fill=fill, state=state)
+
+
+def _merge_station_year_csv(path, df, time="time", keep="last", fill=None, state=None):
+    df = df.drop_duplicates(subset=[time], keep=keep).sort_values(by=time)
+    if fill is not None:
+        df = df.fillna(fill)
+    if len(df) == 0:
+        return None
+
+    if not os.path.exists(path):
+        with atomic_write(path, "w") as f:
+            df.to_csv(f, index=False)
+        write_index(path, time, rows=len(df), state=state)
+        return "new"
+
+    index = read_index(path, state)
+    if index is None or index.get("time") != time:
+        index = write_index(path, time, state=state)
+
+    if index["columns"] == list(df.columns) and index["rows"] > 0:
+        parse = _key_parser(df[time])
+        start = df[time].iloc[0]
+        try:
+            if parse(index["max"]) < start:
+                rewrite_tail(path, index["size"], df.to_csv(index=False, header=False).encode("utf-8"))
+                write_index(path, time, rows=index["rows"] + len(df), state=state)
+                return "append"
+            with open(path, "rb") as f:
+                header = f.readline()
+            offset, tail_rows = _tail_offset(path, len(header), index["columns"].index(time), parse, start)
+        except (TypeError, ValueError):
+            offset = None
+        if offset is not None:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                tail = f.read()
+            combined = pd.concat([_read_frame(header + tail, time, df[time]), df])
+            combined = combined.drop_duplicates(subset=[time], keep=keep)
+            combined = combined.sort_values(by=time)
+            if fill is not None:
+                combined = combined.fillna(fill)
+            rewrite_tail(path, offset, combined.to_csv(index=False, header=False).encode("utf-8"))
+            write_index(path, time, rows=index["rows"] - tail_rows + len(combined), state=state)
+            return "merge"
+
+    with open(path, "rb") as f:
+        existing = f.read()
+    combined = pd.concat([_read_frame(existing, time, df[time]), df])
+    combined = combined.drop_duplicates(subset=[time], keep=keep)
+    combined = combined.sort_values(by=time)
+    if fill is not None:
+        combined = combined.fillna(fill)
+    with atomic_write(path, "w") as f:
+        combined.to_csv(f, index=False)
+    write_index(path, time, rows=len(combined), state=state)
+    return "merge"
+
+
+def write_parquet(df, path):
+    with atomic_write(path) as f:
+        df.to_parquet(f, index=False, compression="zstd", row_group_size=10000)
+
+
+def _parquet_types(df):
+    """
+    Give every column a single type for parquet, columns mixing text with other values (e.g. "-" in a numeric column
+    of one day) are stored as text, as they are written to csv.
+    """
+    for column in df.columns:
+        if df[column].dtype == object:
+            values = df[column].dropna()
+            text = values.map(lambda v: isinstance(v, str))
+            if text.any() and not text.all():
+                df[column] = df[column].map(lambda v: v if isinstance(v, str) or pd.isnull(v) else str(v))
+    return df
+
+
+def parquet_time_range(path, time):
+    """
+    Read the min/max time of a parquet file from its row group statistics.
+
+    :return: Tuple (min, max), (None, None) if the statistics are not available
+    """
+    import pyarrow.parquet as pq
+    metadata = pq.ParquetFile(path).metadata
+    names = metadata.schema.names
+    if time not in names or metadata.num_row_groups == 0:
+        return None, None
+    position = names.index(time)
+    minimum, maximum = [], []
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(position).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None, None
+        minimum.append(pd.Timestamp(statistics.min) if isinstance(statistics.min, datetime) else statistics.min)
+        maximum.append(pd.Timestamp(statistics.max) if isinstance(statistics.max, datetime) else statistics.max)
+    return min(minimum), max(maximum)
+
+
+def merge_station_year_parquet(path, df, time="time", keep="last", fill=None):
+    """
+    Merge new rows into a station year parquet file.
+
+    Parquet files are written with a typed time column, zstd compression and row group statistics. The statistics
+    are used to skip deduplicating and sorting when the new rows all come after the existing data.
+
+    :param path: Path to the station year parquet file
+    :param df: DataFrame of new data
+    :param time: Name of the time column used to deduplicate and sort the rows
+    :param keep: Which duplicate to keep, "last" prefers the new data and "first" the existing data
+    :param fill: Value used to fill missing data
+    :return: Operation performed ("new", "append" or "merge"), None if there was no data
+    """
+    df = df.drop_duplicates(subset=[time], keep=keep).sort_values(by=time)
+    if fill is not None:
+        df = df.fillna(fill)
+    if len(df) == 0:
+        return None
+
+    if not os.path.exists(path):
+        write_parquet(_parquet_types(df), path)
+        return "new"
+
+    existing = pd.read_parquet(path)
+    try:
+        append = list(existing.columns) == list(df.columns) and parquet_time_range(path, time)[1] < df[time].iloc[0]
+    except TypeError:
+        append = False
+    combined = pd.concat([existing, df], ignore_index=True)
+    if not append:
+        combined = combined.drop_duplicates(subset=[time], keep=keep)
+        combined = combined.sort_values(by=time)
+    if fill is not None:
+        combined = combined.fillna(fill)
+    write_parquet(_parquet_types(combined), path)
+    return "append" if append else "merge"
+
+
+def convert_station_files(folder, fmt="parquet", remove=False):
+    """
+    Convert a tree of station year csv files to another format.
+
+    Columns named time or Time are parsed to timestamps. Files that have already been converted are skipped.
+
+    :param folder: Root folder of the station files
+    :param fmt: Output format, only "parquet" is supported
+    :param remove: Remove the csv files (and their sidecar index) once converted
+    :return: List of converted files
+    """
+    if fmt != "parquet":
+        raise ValueError("Invalid format. Use 'parquet'.")
+    converted = []
+    for path in sorted(list_nested_dir(folder)):
+        if not path.endswith(".csv") or os.path.basename(path).startswith("."):
+            continue
+        out = path[:-len(".csv")] + "." + fmt
+        if not os.path.exists(out):
+            df = pd.read_csv(path)
+            for column in ["time", "Time"]:
+                if column in df.columns:
+                    df[column] = pd.to_datetime(df[column])
+            write_parquet(df, out)
+            converted.append(out)
+        if remove:
+            os.unlink(path)
+            if os.path.exists(_index_path(path)):
+                os.unlink(_index_path(path))
+    return converted
+
+
+def merge_station_years(folder, df, fmt="csv", prefix="", log=False, **kwargs):
+    """
+    Split a station DataFrame by year and merge each year into {folder}/{prefix}{year}.{fmt}.
+
+    :param folder: Station folder
+    :param df: DataFrame of new data
+    :param fmt: Output format ("csv" or "parquet")
+    :param prefix: File name prefix
+    :param log: Logger used to report new files and to time the merge
+    :param kwargs: Keyword arguments passed to merge_station_year
+    """
+    for year, year_data in partition_years(df, time=kwargs.get("time", "time")):
+        station_year_file = os.path.join(folder, "{}{}.{}".format(prefix, year, fmt))
+        if log:
+            with log.timer("merge"):
+                status = merge_station_year(station_year_file, year_data, **kwargs)
+            log.count("rows", len(year_data))
+        else:
+            status = merge_station_year(station_year_file, year_data, **kwargs)
+        if status == "new" and log:
+            log.info("Saving file new file {}.".format(station_year_file), indent=1)
+
+
+def partition_years(df, time="time", by=None):
+    """
+    Split a DataFrame into one slice per year, or per value of a column and year, in a single pass.
+
+    The rows are ordered with a single stable sort (no copy is made when they are already in order) and the slices are taken between the group
+    boundaries, so the cost is linear in the number of rows instead of rows x groups for repeated boolean masks.
+
+    :param df: DataFrame with a datetime column
+    :param time: Name of the datetime column
+    :param by: Optional column to group by before the year e.g. the station
+    :return: Generator of tuples (year, DataFrame) or ((value, year), DataFrame) for the non-empty groups
+    """
+    if len(df) == 0:
+        return
+    years = df[time].dt.year.to_numpy()
+    if by is None:
+        keys = [years]
+    else:
+        codes, uniques = pd.factorize(df[by], sort=True)
+        keys = [codes, years]
+    order = np.lexsort(keys[::-1])
+    if (np.diff(order) < 0).any():
+        df = df.iloc[order]
+        keys = [key[order] for key in keys]
+    boundaries = np.zeros(len(df) - 1, dtype=bool)
+    for key in keys:
+        boundaries |= key[1:] != key[:-1]
+    edges = np.concatenate([[0], np.flatnonzero(boundaries) + 1, [len(df)]])
+    for start, end in zip(edges[:-1], edges[1:]):
+        year = int(keys[-1][start])
+        yield (year if by is None else (uniques[keys[0][start]], year)), df.iloc[start:end]
+
+
+class backfill_checkpoint(object):
+    """
+    Checkpointed backfill of station data.
+
+    Each downloaded chunk is staged to disk and recorded in a checkpoint file, so an interrupted backfill resumes with
+    the chunks that are still missing. Once all the chunks of a station are staged they are loaded together and merged
+    into the station year files with a single write per year.
+    """
+    def __init__(self, parent, start, end):
+        self.start = start
+        self.end = end
+        self.folder = os.path.join(parent, ".backfill", "{}_{}".format(start.strftime("%Y%m%d%H%M"), end.strftime("%Y%m%d%H%M")))
+        self.checkpoint = os.path.join(self.folder, "checkpoint.json")
+        self.state = {"staged": {}, "complete": []}
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint, "r") as f:
+                self.state = json.load(f)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def chunks(self, period, unit="days"):
+        return split_date_range(self.start, self.end, period, unit=unit)
+
+    def done(self, station, key):
+        return self.finished(station) or str(key) in self.state["staged"].get(station, {})
+
+    def finished(self, station):
+        return station in self.state["complete"]
+
+    def stage(self, station, key, df):
+        staged = self.state["staged"].setdefault(station, {})
+        file = os.path.join(self.folder, "{}_{}.pkl".format(re.sub(r'[^\w]', '_', station), len(staged)))
+        with atomic_write(file) as f:
+            df.to_pickle(f)
+        staged[str(key)] = file
+        self.save()
+
+    def load(self, station):
+        """
+        :return: List of tuples (key, DataFrame) of the chunks staged for a station
+        """
+        return [(key, pd.read_pickle(file)) for key, file in self.state["staged"].get(station, {}).items()]
+
+    def complete(self, station):
+        for file in self.state["staged"].pop(station, {}).values():
+            if os.path.exists(file):
+                os.unlink(file)
+        self.state["complete"].append(station)
+        self.save()
+
+    def save(self):
+        with atomic_write(self.checkpoint, "w") as f:
+            json.dump(self.state, f)
+
+    def finish(self):
+        shutil.rmtree(self.folder)
+        if len(os.listdir(os.path.dirname(self.folder))) == 0:
+            os.rmdir(os.path.dirname(self.folder))
+
+
+class watermarks(object):
+    """
+    Per station and parameter high-water marks of the data already stored for a source.
+
+    Marks are stored as naive UTC timestamps in {folder}/watermarks.json and used to only request data that is newer
+    than what has already been merged, minus an overlap to pick up late or corrected values.
+    """
+    def __init__(self, folder, name="watermarks.json"):
+        self.path = os.path.join(folder, name)
+        self.marks = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.marks = json.load(f)
+            except ValueError:
+                self.marks = {}
+
+    def get(self, station, parameter):
+        mark = self.marks.get(str(station), {}).get(parameter)
+        return datetime.fromisoformat(mark) if mark else None
+
+    def start(self, station, parameters, default, overlap=timedelta(days=1), stale=timedelta(days=30)):
+        """
+        Start of the period to request for a station.
+
+        After an outage all the watermarks of a station are old and the whole gap is requested again.
+
+        :param station: Station id
+        :param parameters: Parameters requested for the station
+        :param default: Start used when a parameter has no watermark
+        :param overlap: Period before the oldest watermark that is requested again
+        :param stale: Watermarks older than the newest watermark of the station by more than this are ignored, so that a
+            parameter that is no longer reported does not drag the start back
+        :return: datetime (naive UTC)
+        """
+        marks = [self.get(station, p) for p in parameters]
+        if len(marks) == 0 or None in marks:
+            return default
+        return min(mark for mark in marks if mark >= max(marks) - stale) - overlap
+
+    def update(self, station, df, time="time"):
+        """
+        Raise the watermarks of a station to the last non-missing value of each column of a DataFrame.
+        """
+        times = pd.to_datetime(df[time])
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+        marks = self.marks.setdefault(str(station), {})
+        for column in df.columns:
+            if column == time:
+                continue
+            last = times[df[column].notna()].max()
+            if pd.isnull(last):
+                continue
+            if column not in marks or datetime.fromisoformat(marks[column]) < last:
+                marks[column] = last.isoformat()
+
+    def save(self):
+        with atomic_write(self.path, "w") as f:
+            json.dump(self.marks, f, indent=1)
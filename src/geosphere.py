@@ -1,14 +1,14 @@
 import os
 import time
 import json
-import requests
 import numpy as np
 import pandas as pd
+from itertools import chain
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
-from functions import logger, parse_dict_string, split_date_range
+from functions import logger, parse_dict_string, split_date_range, merge_station_years, fetcher, backfill_checkpoint, watermarks
 
-def geosphere_meteodata(data_folder):
+def geosphere_meteodata(data_folder, workers=8, fmt="csv", backfill=None):
     """
     Download Meteodata from Geosphere
     https://dataset.api.hub.geosphere.at/v1/docs/#
@@ -16,9 +16,11 @@ def geosphere_meteodata(data_folder):
     Add new stations
     1. Find closest station https://alplakes-eawag.s3.eu-central-1.amazonaws.com/static/geosphere/geosphere_stations.json
     2. Add station to stations list
-    3. Edit last_updated to an old date
+    3. Run a backfill from the station start date e.g. --backfill 1990-01-01 2025-01-01
     4. Upload data to API
     5. Edit FastAPI list of stations
+
+    :param backfill: Tuple (start, end) of datetimes to backfill instead of fetching the last two weeks
     """
 
     stations = [
@@ -41,7 +43,7 @@ def geosphere_meteodata(data_folder):
     ]
     failed = []
 
-    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="geosphere_meteodata")
     log.initialise("Download Meteodata from Geosphere")
 
     log.info("Ensure data folder exists.")
@@ -49,40 +51,49 @@ def geosphere_meteodata(data_folder):
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    current_date = datetime.now()
+    current_date = datetime.utcnow()
     last_update = current_date - timedelta(weeks=2)
     url = "https://dataset.api.hub.geosphere.at/v1/station/historical/klima-v2-10min?{}&start={}&end={}&station_ids={}"
 
+    if backfill is not None:
+        log.info("Backfilling data from {} to {}".format(backfill[0], backfill[1]))
+        checkpoint = backfill_checkpoint(parent, backfill[0], backfill[1])
+        last_update, current_date = backfill
+
+    marks = watermarks(parent)
+    # The API allows 5 requests per second and 240 per hour, 429 responses are retried after Retry-After
+    fetch = fetcher(workers=workers, metrics=log.metrics, rate=5, burst=5)
+    jobs = []
     for station in stations:
-        log.info("Downloading data for station {}".format(station["id"]))
-        start_date = max(last_update, datetime.fromisoformat(station["start"]))
+        if backfill is None:
+            start_date = max(marks.start(station["id"], station["parameters"], last_update), datetime.fromisoformat(station["start"]))
+        else:
+            start_date = max(last_update, datetime.fromisoformat(station["start"]))
         for chunk in split_date_range(start_date, current_date, 1, unit="years"):
-            log.info("Accessing data from {} to {}".format(chunk[0], chunk[1]), indent=1)
+            if backfill is not None and checkpoint.done(station["id"], chunk[0].isoformat()):
+                continue
             u = url.format("&".join(["parameters={}".format(p) for p in station["parameters"]]), chunk[0].isoformat(), chunk[1].isoformat(), station["id"])
-            response = requests.get(u)
-            if response.status_code == 200:
+            jobs.append(((station, chunk), u))
+
+    pending = {station["id"]: 0 for station in stations}
+    for job in jobs:
+        pending[job[0][0]["id"]] += 1
+
+    log.info("Downloading {} time periods for {} stations".format(len(jobs), len(stations)))
+    completed = [((station, None), None) for station in stations if pending[station["id"]] == 0]
+    for (station, chunk), response in chain(completed, fetch.map(jobs)):
+        if chunk is not None:
+            pending[station["id"]] -= 1
+            log.info("Processing data for station {} from {} to {}".format(station["id"], chunk[0], chunk[1]))
+            if not isinstance(response, Exception) and response.status_code == 200:
                 try:
-                    raw_data = response.json()
-                    dict = {"time": raw_data["timestamps"]}
-                    for p in station["parameters"]:
-                        dict[p] = raw_data["features"][0]["properties"]["parameters"][p]["data"]
-                    df = pd.DataFrame(dict)
-                    df['time'] = pd.to_datetime(df['time'])
-                    df = df.dropna(how='all', subset=df.columns.difference(['time']))
-                    for year in range(df['time'].min().year, df['time'].max().year + 1):
-                        station_year_file = os.path.join(parent, station["id"], "{}.csv".format(year))
-                        station_year_data = df[df['time'].dt.year == year]
-                        if not os.path.exists(station_year_file):
-                            log.info("Saving file new file {}.".format(station_year_file), indent=1)
-                            os.makedirs(os.path.dirname(station_year_file), exist_ok=True)
-                            station_year_data.to_csv(station_year_file, index=False)
-                        else:
-                            df_existing = pd.read_csv(station_year_file)
-                            df_existing['time'] = pd.to_datetime(df_existing['time'])
-                            combined = pd.concat([df_existing, station_year_data])
-                            combined = combined.drop_duplicates(subset=['time'], keep='last')
-                            combined = combined.sort_values(by='time')
-                            combined.to_csv(station_year_file, index=False)
+                    with log.timer("parse"):
+                        df = parse_geosphere_data(response.content, station["parameters"])
+                    if backfill is None:
+                        merge_station_years(os.path.join(parent, station["id"]), df, fmt=fmt, log=log)
+                        marks.update(station["id"], df)
+                    else:
+                        checkpoint.stage(station["id"], chunk[0].isoformat(), df)
                 except:
                     log.info("FAILED", indent=1)
                     if station["id"] not in failed:
@@ -92,7 +103,42 @@ def geosphere_meteodata(data_folder):
                 if station["id"] not in failed:
                     failed.append(station["id"])
 
+        if backfill is not None and pending[station["id"]] == 0 and station["id"] not in failed and not checkpoint.finished(station["id"]):
+            log.info("Merging backfill for station {}".format(station["id"]))
+            try:
+                dfs = [df for key, df in checkpoint.load(station["id"])]
+                if len(dfs) > 0:
+                    df = pd.concat(dfs)
+                    merge_station_years(os.path.join(parent, station["id"]), df, fmt=fmt, log=log)
+                    marks.update(station["id"], df)
+                checkpoint.complete(station["id"])
+            except:
+                log.info("FAILED", indent=1)
+                failed.append(station["id"])
+
+    fetch.close()
+    marks.save()
+    log.close()
+
+    if backfill is not None and len(failed) == 0:
+        checkpoint.finish()
+
     if len(failed) > 0:
         raise ValueError("Failed to download at least one time period from: {}".format(", ".join(failed)))
 
 
+def parse_geosphere_data(content, parameters):
+    """
+    Parse the GeoJSON response of the Geosphere station API.
+
+    :param content: Response content (bytes)
+    :param parameters: Parameters to read
+    :return: DataFrame with a time column and one column per parameter, rows without any data are dropped
+    """
+    raw_data = json.loads(content)
+    data = {"time": raw_data["timestamps"]}
+    for p in parameters:
+        data[p] = raw_data["features"][0]["properties"]["parameters"][p]["data"]
+    df = pd.DataFrame(data)
+    df['time'] = pd.to_datetime(df['time'])
+    return df.dropna(how='all', subset=df.columns.difference(['time']))
@@ -1,49 +1,40 @@
 # -*- coding: utf-8 -*-
 import sys
 import argparse
-from meteoswiss import cosmo, icon, meteodata
-from bafu import hydrodata
-from arso import arso_meteodata
-from geosphere import geosphere_meteodata
-from mistral import mistral_meteodata
-from thredds import thredds_meteodata
-from dwd import dwd_meteodata
-
-
+from datetime import datetime
+from sources import registry, select_sources, run_sources
 
 
 def main(params):
-    setups = ["meteoswiss_cosmo", "bafu_hydrodata", "meteoswiss_meteodata", "meteoswiss_icon", "arso_meteodata", "dwd_meteodata"]
-    if params["source"] == "meteoswiss_cosmo":
-        cosmo(params["filesystem"], params["password"])
-    elif params["source"] == "meteoswiss_icon":
-        icon(params["filesystem"], params["password"])
-    elif params["source"] == "meteoswiss_meteodata":
-        meteodata(params["filesystem"], params["password"])
-    elif params["source"] == "bafu_hydrodata":
-        hydrodata(params["filesystem"], params["key"])
-    elif params["source"] == "arso_meteodata":
-        arso_meteodata(params["filesystem"])
-    elif params["source"] == "geosphere_meteodata":
-        geosphere_meteodata(params["filesystem"])
-    elif params["source"] == "mistral_meteodata":
-        mistral_meteodata(params["filesystem"], params["user"], params["password"])
-    elif params["source"] == "thredds_meteodata":
-        thredds_meteodata(params["filesystem"])
-    elif params["source"] == "dwd_meteodata":
-        dwd_meteodata(params["filesystem"])
+    if params["metrics_textfile"]:
+        from functions import logger
+        logger.textfile = params["metrics_textfile"]
+    if params["backfill"]:
+        params["backfill"] = tuple(datetime.fromisoformat(d) for d in params["backfill"])
+    if params["sources"]:
+        run_sources(select_sources(params["sources"]), params, parallel=params["parallel"])
+    elif params["source"] in registry:
+        source = registry[params["source"]]
+        source.run(source.params(params))
     else:
-        raise Exception("Currently only the following sources are supported: {}".format(setups))
+        raise Exception("Currently only the following sources are supported: {}".format(", ".join(registry)))
 
 
 if __name__ == "__main__":
     if sys.version_info[0:2] != (3, 9):
         raise Exception('Requires python 3.9')
     parser = argparse.ArgumentParser()
-    parser.add_argument('--source', '-s', help="Data source [meteoswiss_cosmo, bafu_hydrodata, meteoswiss_meteodata, meteoswiss_icon]", type=str)
+    parser.add_argument('--source', '-s', help="Data source [{}]".format(", ".join(registry)), type=str)
+    parser.add_argument('--sources', help="Run several sources in one process, \"all\" or a comma separated list of sources", type=str, default=None)
+    parser.add_argument('--parallel', help="Number of sources running at the same time with --sources", type=int, default=4)
     parser.add_argument('--filesystem', '-f', help="Path to local storage filesystem", type=str,)
     parser.add_argument('--user', '-u', help="Username", type=str, default=False)
     parser.add_argument('--password', '-p', help="Password", type=str, default=False)
     parser.add_argument('--key', '-k', help="Path to ssh key file", type=str, default=False)
+    parser.add_argument('--workers', '-w', help="Number of concurrent downloads, or merge processes for bafu_hydrodata", type=int, default=8)
+    parser.add_argument('--connections', '-c', help="Number of concurrent sftp connections", type=int, default=4)
+    parser.add_argument('--format', help="Output format for station files [csv, parquet]", type=str, default="csv", choices=["csv", "parquet"])
+    parser.add_argument('--backfill', help="Backfill a time period instead of the latest data e.g. --backfill 2020-01-01 2021-01-01", type=str, nargs=2, metavar=("FROM", "TO"), default=None)
+    parser.add_argument('--metrics-textfile', help="Folder to write Prometheus metrics of the run to e.g. the node exporter textfile collector folder", type=str, default=None)
     args = parser.parse_args()
     main(vars(args))
@@ -2,10 +2,12 @@ import os
 import pysftp
 import fnmatch
 import pandas as pd
-from functions import logger, unzip_combine, progressbar
+from functions import logger, progressbar, merge_station_year, partition_years, atomic_write
+from netcdf import unzip_combine
+from sftp import sftp_pool
 
 
-def cosmo(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_user="cosmo", progress=False):
+def cosmo(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_user="cosmo", progress=False, connections=4):
     """
     Download COSMO data from Eawag sftp server.
     Available files:
@@ -19,9 +21,7 @@ def cosmo(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_
              {"name": "VNXQ34.*0000.nc", "parent": "data/reanalysis", "folder": "VNXQ34"},
              {"name": "VNJK21.*0000.nc", "parent": "data/reanalysis", "folder": "VNJK21"}]
 
-    failed = []
-
-    log = logger("cosmo", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("cosmo", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="meteoswiss_cosmo")
     log.initialise("Download COSMO data from Eawag sftp server")
 
     log.info("Ensure data folder exists.")
@@ -29,51 +29,20 @@ def cosmo(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    log.info("Connecting to {}".format(ftp_host))
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-    conn = pysftp.Connection(host=ftp_host, port=ftp_port, username=ftp_user, password=ftp_password, cnopts=cnopts)
-    log.info("Successfully connected to {}".format(ftp_host), indent=1)
+    log.info("Connecting to {} with {} connections".format(ftp_host, connections))
+    pool = sftp_pool(ftp_host, ftp_user, password=ftp_password, port=ftp_port, connections=connections, metrics=log.metrics)
 
-    for file in files:
-        log.info("Downloading {} files".format(file["folder"]))
-        folder = os.path.join(data_folder, "meteoswiss/cosmo", file["folder"])
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        server_files = [f for f in conn.listdir(file["parent"]) if fnmatch.fnmatch(f, file["name"])]
-        log.info("Found {} files matching file name pattern {}".format(len(server_files), file["name"]), indent=1)
-        for server_file in server_files:
-            if os.path.isfile(os.path.join(parent, file["folder"], server_file.replace(".zip", ".nc"))):
-                log.info("File {} already downloaded, skipping.".format(server_file), indent=2)
-            elif os.path.isfile(os.path.join(parent, file["folder"], server_file.replace(".nc", ".zip"))):
-                log.info("File {} already downloaded, unzipping.".format(server_file), indent=2)
-                unzip_combine(os.path.join(parent, file["folder"], server_file))
-            else:
-                log.info("Downloading file {}.".format(server_file), indent=2)
-                try:
-                    if progress:
-                        conn.get(os.path.join(file["parent"], server_file),
-                                 os.path.join(parent, file["folder"], server_file),
-                                 callback=lambda x, y: progressbar(x, y))
-                    else:
-                        conn.get(os.path.join(file["parent"], server_file),
-                                 os.path.join(parent, file["folder"], server_file))
-                    if ".zip" in server_file:
-                        unzip_combine(os.path.join(parent, file["folder"], server_file))
-                except:
-                    log.error("Failed to download {}.".format(server_file))
-                    if os.path.exists(os.path.join(parent, file["folder"], server_file)):
-                        os.unlink(os.path.join(parent, file["folder"], server_file))
-                    failed.append(server_file)
+    failed = download_server_files(pool, files, parent, log, progress=progress)
 
-    log.info("Closing connection to {}".format(ftp_host))
-    conn.close()
+    log.info("Closing connections to {}".format(ftp_host))
+    pool.close()
+    log.close()
 
     if len(failed) > 0:
         raise ValueError("Failed to download: {}".format(", ".join(failed)))
 
 
-def icon(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_user="cosmo", progress=False):
+def icon(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_user="cosmo", progress=False, connections=4):
     """
     Download ICON data from Eawag sftp server.
     Available files:
@@ -87,9 +56,7 @@ def icon(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_u
              {"name": "*_00_kenda-ch1_eawag_lakes.nc", "parent": "data/kenda-ch1", "folder": "kenda-ch1"},
              {"name": "*_00_kenda-ch1_eawag_lake_geneva_ensemble.nc", "parent": "data/kenda-ch1", "folder": "kenda-ch1-e"}]
 
-    failed = []
-
-    log = logger("icon", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("icon", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="meteoswiss_icon")
     log.initialise("Download ICON data from Eawag sftp server")
 
     log.info("Ensure data folder exists.")
@@ -97,59 +64,86 @@ def icon(data_folder, ftp_password, ftp_host="sftp.eawag.ch", ftp_port=22, ftp_u
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    log.info("Connecting to {}".format(ftp_host))
-    cnopts = pysftp.CnOpts()
-    cnopts.hostkeys = None
-    conn = pysftp.Connection(host=ftp_host, port=ftp_port, username=ftp_user, password=ftp_password, cnopts=cnopts)
-    log.info("Successfully connected to {}".format(ftp_host), indent=1)
+    log.info("Connecting to {} with {} connections".format(ftp_host, connections))
+    pool = sftp_pool(ftp_host, ftp_user, password=ftp_password, port=ftp_port, connections=connections, metrics=log.metrics)
+
+    failed = download_server_files(pool, files, parent, log, progress=progress)
+
+    log.info("Closing connections to {}".format(ftp_host))
+    pool.close()
+    log.close()
+
+    if len(failed) > 0:
+        raise ValueError("Failed to download: {}".format(", ".join(failed)))
+
 
+def download_server_files(pool, files, parent, log, progress=False):
+    """
+    Download the server files matching each file name pattern that are not available locally.
+    Zip files are combined into a single NetCDF file once downloaded.
+
+    :return: List of server files that failed to download
+    """
+    failed = []
+    jobs = []
     for file in files:
-        log.info("Downloading {} files".format(file["folder"]))
-        folder = os.path.join(data_folder, "meteoswiss/icon", file["folder"])
+        log.info("Listing {} files".format(file["folder"]))
+        folder = os.path.join(parent, file["folder"])
         if not os.path.exists(folder):
             os.makedirs(folder)
-        server_files = [f for f in conn.listdir(file["parent"]) if fnmatch.fnmatch(f, file["name"])]
+        server_files = sorted([f for f in pool.listdir_attr(file["parent"]) if fnmatch.fnmatch(f.filename, file["name"])], key=lambda f: f.filename)
         log.info("Found {} files matching file name pattern {}".format(len(server_files), file["name"]), indent=1)
-        for server_file in server_files:
-            if os.path.isfile(os.path.join(parent, file["folder"], server_file.replace(".zip", ".nc"))):
+        for attr in server_files:
+            server_file = attr.filename
+            local_file = os.path.join(folder, server_file)
+            complete = os.path.isfile(local_file) and os.path.getsize(local_file) == attr.st_size
+            if ".zip" in server_file and os.path.isfile(local_file.replace(".zip", ".nc")):
                 log.info("File {} already downloaded, skipping.".format(server_file), indent=2)
-            elif os.path.isfile(os.path.join(parent, file["folder"], server_file.replace(".nc", ".zip"))):
+            elif complete and ".zip" in server_file:
                 log.info("File {} already downloaded, unzipping.".format(server_file), indent=2)
-                unzip_combine(os.path.join(parent, file["folder"], server_file))
+                with log.timer("combine"):
+                    unzip_combine(local_file)
+            elif complete:
+                log.info("File {} already downloaded, skipping.".format(server_file), indent=2)
             else:
-                log.info("Downloading file {}.".format(server_file), indent=2)
-                try:
-                    if progress:
-                        conn.get(os.path.join(file["parent"], server_file),
-                                 os.path.join(parent, file["folder"], server_file),
-                                 callback=lambda x, y: progressbar(x, y))
-                    else:
-                        conn.get(os.path.join(file["parent"], server_file),
-                                 os.path.join(parent, file["folder"], server_file))
-                    if ".zip" in server_file:
-                        unzip_combine(os.path.join(parent, file["folder"], server_file))
-                except:
-                    log.error("Failed to download {}.".format(server_file))
-                    if os.path.exists(os.path.join(parent, file["folder"], server_file)):
-                        os.unlink(os.path.join(parent, file["folder"], server_file))
-                    failed.append(server_file)
+                if os.path.isfile(local_file):
+                    log.info("File {} is incomplete, downloading again.".format(server_file), indent=2)
+                    os.unlink(local_file)
+                elif os.path.isfile(local_file + ".part"):
+                    log.info("Resuming partial download of {}.".format(server_file), indent=2)
+                jobs.append(((server_file, local_file), os.path.join(file["parent"], server_file), local_file))
 
-    log.info("Closing connection to {}".format(ftp_host))
-    conn.close()
-
-    if len(failed) > 0:
-        raise ValueError("Failed to download: {}".format(", ".join(failed)))
+    log.info("Downloading {} files".format(len(jobs)))
+    callback = (lambda x, y: progressbar(x, y)) if progress else None
+    for (server_file, local_file), error in pool.map(jobs, callback=callback):
+        try:
+            if error is not None:
+                raise error
+            log.info("Downloaded file {}.".format(server_file), indent=1)
+            if ".zip" in server_file:
+                with log.timer("combine"):
+                    unzip_combine(local_file)
+        except Exception as e:
+            log.error("Failed to download {}.".format(server_file), e, indent=1)
+            if os.path.exists(local_file):
+                os.unlink(local_file)
+            failed.append(server_file)
+    return failed
 
 
-def meteodata(data_folder, ftp_password, folder="data", ftp_host="sftp.eawag.ch", ftp_port=22, ftp_user="simstrat"):
+def meteodata(data_folder, ftp_password, folder="data", ftp_host="sftp.eawag.ch", ftp_port=22, ftp_user="simstrat", fmt="csv", batch=31):
     """
     Download Meteodata from Eawag sftp server.
     A single file for the previous day is made available at around 10:15am and contains hourly data for a number of stations.
     This function looks for any non downloaded dates and process these files.
+
+    Files are read straight from the server without a temporary file. Pending files are processed in batches of up to
+    batch files: the rows of all the files of a batch are grouped by station and year and each station year file is
+    merged once per batch, so catching up after an outage does not rewrite the station files once per day.
     """
     failed = []
 
-    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="meteoswiss_meteodata")
     log.initialise("Download Meteodata from Eawag sftp server")
 
     log.info("Ensure data folder exists.")
@@ -163,7 +157,8 @@ def meteodata(data_folder, ftp_password, folder="data", ftp_host="sftp.eawag.ch"
     conn = pysftp.Connection(host=ftp_host, port=ftp_port, username=ftp_user, password=ftp_password, cnopts=cnopts)
     log.info("Successfully connected to {}".format(ftp_host))
 
-    server_files = conn.listdir(folder)
+    with log.timer("list"):
+        server_files = conn.listdir(folder)
     server_files.sort()
     last_update_file = os.path.join(parent, "last_update.txt")
 
@@ -176,41 +171,45 @@ def meteodata(data_folder, ftp_password, folder="data", ftp_host="sftp.eawag.ch"
             log.error("Failed to read last_update.txt, processing all files.", e)
 
     if len(server_files) > 0:
-        log.info("Processing {} files.".format(len(server_files)))
-        for server_file in server_files:
-            log.info("Downloading file {}.".format(server_file), indent=1)
-            temp_file = os.path.join(parent, server_file + ".temp")
-            try:
-                conn.get(os.path.join(folder, server_file), temp_file)
-                df = pd.read_csv(temp_file, sep=";")
+        log.info("Processing {} files in batches of up to {} files.".format(len(server_files), batch))
+        for i in range(0, len(server_files), batch):
+            frames = []
+            for server_file in server_files[i:i + batch]:
+                log.info("Reading file {}.".format(server_file), indent=1)
+                try:
+                    with log.timer("download"):
+                        df, size = read_vqca44(conn, os.path.join(folder, server_file))
+                    log.count("files")
+                    log.count("bytes", size)
+                    frames.append(df)
+                except Exception as e:
+                    log.error("Failed to download {}.".format(server_file), e)
+                    failed.append(server_file)
+            if len(frames) == 0:
+                continue
+
+            with log.timer("parse"):
+                df = concat_vqca44(frames)
                 df["time"] = pd.to_datetime(df['Date'], format='%Y%m%d%H', utc=True)
-                for station in df["Station/Location"].unique():
-                    log.info("Processing station {}.".format(station), indent=2)
-                    if not os.path.exists(os.path.join(parent, station)):
-                        os.makedirs(os.path.join(parent, station))
-                    station_data = df.loc[df['Station/Location'] == station]
-                    for year in range(df['time'].min().year, df['time'].max().year + 1):
-                        station_year_file = os.path.join(parent, station, "VQCA44.{}.csv".format(year))
-                        station_year_data = station_data[station_data['time'].dt.year == year].drop('time', axis=1)
-                        if not os.path.exists(station_year_file):
-                            log.info("Saving file new file {}.".format(station_year_file), indent=3)
-                            station_year_data.to_csv(station_year_file, index=False)
-                        else:
-                            df_existing = pd.read_csv(station_year_file)
-                            combined = pd.concat([df_existing, station_year_data])
-                            combined = combined.drop_duplicates(subset=['Date'])
-                            combined = combined.sort_values(by='Date')
-                            combined.fillna('-', inplace=True)
-                            combined.to_csv(station_year_file, index=False)
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-            except Exception as e:
-                log.error("Failed to download {}.".format(server_file), e)
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-                failed.append(server_file)
-
-        with open(last_update_file, "w") as f:
+            frames = None
+            current = None
+            for (station, year), station_year_data in partition_years(df, time="time", by="Station/Location"):
+                if station != current:
+                    log.info("Processing station {}.".format(station), indent=1)
+                    current = station
+                station_year_file = os.path.join(parent, station, "VQCA44.{}.{}".format(year, fmt))
+                station_year_data = station_year_data.drop('time', axis=1)
+                try:
+                    with log.timer("merge"):
+                        status = merge_station_year(station_year_file, station_year_data, time="Date", keep="first", fill="-")
+                    log.count("rows", len(station_year_data))
+                    if status == "new":
+                        log.info("Saving file new file {}.".format(station_year_file), indent=2)
+                except Exception as e:
+                    log.error("Failed to merge {}.".format(station_year_file), e, indent=2)
+                    failed.append("{} ({})".format(station, year))
+
+        with atomic_write(last_update_file, "w") as f:
             f.write(server_files[-1].split(".")[1][:8])
 
     else:
@@ -218,7 +217,40 @@ def meteodata(data_folder, ftp_password, folder="data", ftp_host="sftp.eawag.ch"
 
     log.info("Closing connection to {}".format(ftp_host))
     conn.close()
+    log.close()
 
     if len(failed) > 0:
         raise ValueError("Failed to download and process: {}".format(", ".join(failed)))
 
+
+def read_vqca44(conn, remote):
+    """
+    Read a VQCA44 file straight from the sftp server.
+
+    :param conn: pysftp Connection
+    :param remote: Remote file path
+    :return: Tuple (DataFrame, size of the file in bytes)
+    """
+    with conn.open(remote, "rb") as f:
+        size = f.stat().st_size
+        f.prefetch(size)
+        return pd.read_csv(f, sep=";"), size
+
+
+def concat_vqca44(frames):
+    """
+    Concatenate the VQCA44 files of a batch, keeping the order of the files.
+
+    Columns that were read with different types in different files (e.g. integers in one and floats in another) are
+    kept as objects so that the values are written as they were read rather than all converted to floats.
+    """
+    if len(frames) == 1:
+        return frames[0]
+    dtypes = {}
+    for df in frames:
+        for column, dtype in df.dtypes.items():
+            dtypes.setdefault(column, set()).add(dtype)
+    mixed = [column for column in dtypes if len(dtypes[column]) > 1 and column not in ["Station/Location", "Date"]]
+    if len(mixed) > 0:
+        frames = [df.astype({column: object for column in mixed if column in df.columns}) for df in frames]
+    return pd.concat(frames, ignore_index=True)
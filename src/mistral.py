@@ -1,18 +1,23 @@
 import os
 import time
 import json
-import requests
+import base64
 import numpy as np
 import pandas as pd
-from functools import reduce
+from itertools import chain
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
-from functions import logger, merge_dfs
+from functions import logger, merge_station_years, fetcher, backfill_checkpoint, watermarks, atomic_write
 
-def mistral_meteodata(data_folder, user, password):
+def mistral_meteodata(data_folder, user, password, workers=8, fmt="csv", backfill=None):
     """
     Download Meteodata from Mistral
     https://meteohub.mistralportal.it:7777/
+
+    Stations are requested in one bounding box query per network and time period. The authentication token is kept in
+    {data_folder}/mistral/meteodata/.token.json and reused by later runs until it expires.
+
+    :param backfill: Tuple (start, end) of datetimes to backfill in weekly chunks instead of fetching the last week
     """
     stations = [
         {"id": "trn196", "parameters": ['B14198', 'B12101', 'B13003', 'B11001', 'B11002'], "lat": 46.06192, "lng": 11.12041, "network": "mnw"},
@@ -26,7 +31,7 @@ def mistral_meteodata(data_folder, user, password):
     ]
     failed = []
 
-    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="mistral_meteodata")
     log.initialise("Download Meteodata from Mistral")
 
     log.info("Ensure data folder exists.")
@@ -34,8 +39,128 @@ def mistral_meteodata(data_folder, user, password):
     if not os.path.exists(parent):
         os.makedirs(parent)
 
+    if os.path.exists(os.path.join(parent, ".token.json")):
+        os.unlink(os.path.join(parent, ".token.json"))
+    fetch = fetcher(workers=workers, metrics=log.metrics)
+    token = mistral_token(fetch, user, password, log)
+    headers = {'accept': 'application/json', 'Authorization': f'Bearer {token}'}
+
+    current_date = datetime.now()
+    last_update = current_date - timedelta(weeks=1)
+    url = "https://meteohub.mistralportal.it/api/observations?q=reftime:%20%3E={}%2000:00,%3C={}%2023:59;license:CCBY_COMPLIANT;timerange:254,0,0&allStationProducts=true&networks={}&latmin={}&lonmin={}&latmax={}&lonmax={}"
+
+    marks = watermarks(parent)
+    if backfill is None:
+        chunks = [(min(marks.start(station["id"], station["parameters"], last_update) for station in stations), current_date)]
+    else:
+        log.info("Backfilling data from {} to {}".format(backfill[0], backfill[1]))
+        checkpoint = backfill_checkpoint(parent, backfill[0], backfill[1])
+        chunks = [(chunk[0], max(chunk[0], chunk[1] - timedelta(days=1))) for chunk in checkpoint.chunks(7)]
+
+    networks = {}
+    for station in stations:
+        networks.setdefault(station["network"], []).append(station)
+
+    jobs = []
+    pending = {station["id"]: 0 for station in stations}
+    for network, members in networks.items():
+        for chunk in chunks:
+            members_chunk = [s for s in members if backfill is None or not checkpoint.done(s["id"], chunk[0].isoformat())]
+            if len(members_chunk) == 0:
+                continue
+            for station in members_chunk:
+                pending[station["id"]] += 1
+            jobs.append(((network, chunk, members_chunk), url.format(
+                chunk[0].strftime("%Y-%m-%d"), chunk[1].strftime("%Y-%m-%d"), network,
+                min(s["lat"] for s in members_chunk) - 0.001, min(s["lng"] for s in members_chunk) - 0.001,
+                max(s["lat"] for s in members_chunk) + 0.001, max(s["lng"] for s in members_chunk) + 0.001)))
+
+    log.info("Downloading {} batches for {} stations".format(len(jobs), len(stations)))
+    completed = [((None, None, [station for station in stations if pending[station["id"]] == 0]), None)]
+    for (network, chunk, members), response in chain(completed, fetch.map(jobs, headers=headers)):
+        frames = None
+        if chunk is not None:
+            log.info("Processing data for network {} from {} to {}".format(network, chunk[0], chunk[1]))
+            try:
+                if isinstance(response, Exception) or response.status_code != 200:
+                    raise ValueError("Status code not valid")
+                with log.timer("parse"):
+                    frames = read_observations(response.json()["data"], members)
+            except Exception as e:
+                print(e)
+
+        for station in members:
+            folder = os.path.join(parent, station["id"].lower().replace(" ", "_").replace(".", "_"))
+            if chunk is not None:
+                pending[station["id"]] -= 1
+                try:
+                    if frames is None:
+                        raise ValueError("No data for station {}".format(station["id"]))
+                    df = frames[station["id"]]
+                    if backfill is None:
+                        merge_station_years(folder, df, fmt=fmt, log=log)
+                        marks.update(station["id"], df)
+                    else:
+                        checkpoint.stage(station["id"], chunk[0].isoformat(), df)
+                except Exception as e:
+                    print(e)
+                    if station["id"] not in failed:
+                        failed.append(station["id"])
+
+            if backfill is not None and pending[station["id"]] == 0 and station["id"] not in failed and not checkpoint.finished(station["id"]):
+                log.info("Merging backfill for station {}".format(station["id"]))
+                try:
+                    dfs = [df for key, df in checkpoint.load(station["id"])]
+                    if len(dfs) > 0:
+                        df = pd.concat(dfs)
+                        merge_station_years(folder, df, fmt=fmt, log=log)
+                        marks.update(station["id"], df)
+                    checkpoint.complete(station["id"])
+                except Exception as e:
+                    print(e)
+                    failed.append(station["id"])
+
+    fetch.close()
+    marks.save()
+    log.close()
+
+    if backfill is not None and len(failed) == 0:
+        checkpoint.finish()
+
+    if len(failed) > 0:
+        raise ValueError("Failed to download and process: {}".format(", ".join(failed)))
+
+
+def mistral_token(fetch, user, password, log, file=None):
+    """
+    Get an authentication token, reusing the token of a previous run if it has not expired.
+
+    The token is kept outside the data folder, readable by the user only.
+
+    :param file: Token file, defaults to alplakes-externaldata/mistral_token.json in the user state directory
+        ($XDG_STATE_HOME or ~/.local/state)
+    :return: Token string
+    """
+    if file is None:
+        state = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+        file = os.path.join(state, "alplakes-externaldata", "mistral_token.json")
+    if os.path.exists(file):
+        try:
+            with open(file, "r") as f:
+                saved = json.load(f)
+            if saved["user"] == user and saved["expires"] > time.time() + 600:
+                response = fetch.get("https://meteohub.mistralportal.it/auth/profile", headers={
+                    'accept': 'application/json',
+                    'Authorization': 'Bearer {}'.format(saved["token"])
+                })
+                if response.status_code == 200:
+                    log.info("Reusing authentication token.")
+                    return saved["token"]
+        except Exception:
+            pass
+
     log.info("Collecting authentication token.")
-    response = requests.post("https://meteohub.mistralportal.it/auth/login", json={
+    response = fetch.post("https://meteohub.mistralportal.it/auth/login", json={
         'username': user,
         'password': password
     }, headers={
@@ -45,63 +170,55 @@ def mistral_meteodata(data_folder, user, password):
     if response.status_code != 200:
         raise ValueError("Failed to authenticate with Mistral server")
     token = response.json()
+    with atomic_write(file, "w", permissions=0o600) as f:
+        json.dump({"user": user, "token": token, "expires": token_expiry(token)}, f)
+    return token
 
-    current_date = datetime.now()
-    last_update = current_date - timedelta(weeks=1)
-    url = "https://meteohub.mistralportal.it/api/observations?q=reftime:%20%3E={}%2000:00,%3C={}%2023:59;license:CCBY_COMPLIANT;timerange:254,0,0&allStationProducts=true&networks={}&latmin={}&lonmin={}&latmax={}&lonmax={}"
 
-    for station in stations:
-        log.info("Downloading data for station {}".format(station["id"]))
-        u = url.format(last_update.strftime("%Y-%m-%d"), current_date.strftime("%Y-%m-%d"), station["network"],
-                       station["lat"] - 0.001, station["lng"] - 0.001, station["lat"] + 0.001, station["lng"] + 0.001)
-        response = requests.get(u, headers={
-            'accept': 'application/json',
-            'Authorization': f'Bearer {token}'
-        })
-        if response.status_code == 200:
-            try:
-                data = response.json()["data"][0]["prod"]
-                dfs = []
-                for p in data:
-                    if p["var"] in station["parameters"]:
-                        d = {"time": [], p["var"]: []}
-                        for v in p["val"]:
-                            d["time"].append(v["ref"])
-                            d[p["var"]].append(v["val"])
-                        df = pd.DataFrame(d)
-                        df["time"] = pd.to_datetime(df['time'])
-                        df = df.sort_values(by='time').reset_index(drop=True)
-                        dfs.append(df)
-                df = reduce(merge_dfs, dfs)
-                df = df.sort_values(by='time').reset_index(drop=True)
-                for p in station["parameters"]:
-                    if p not in df.columns:
-                        df[p] = None
-                for year in range(df['time'].min().year, df['time'].max().year + 1):
-                    station_year_file = os.path.join(parent, station["id"].lower().replace(" ", "_").replace(".", "_"), "{}.csv".format(year))
-                    station_year_data = df[df['time'].dt.year == year]
-                    if not os.path.exists(station_year_file):
-                        log.info("Saving file new file {}.".format(station_year_file), indent=1)
-                        os.makedirs(os.path.dirname(station_year_file), exist_ok=True)
-                        station_year_data.to_csv(station_year_file, index=False)
-                    else:
-                        df_existing = pd.read_csv(station_year_file)
-                        df_existing['time'] = pd.to_datetime(df_existing['time'])
-                        combined = pd.concat([df_existing, station_year_data])
-                        combined = combined.drop_duplicates(subset=['time'], keep='last')
-                        combined = combined.sort_values(by='time')
-                        combined.to_csv(station_year_file, index=False)
-            except Exception as e:
-                print(e)
-                failed.append(station["id"])
-        else:
-            print(response)
-            failed.append(station["id"])
+def token_expiry(token, default=3600):
+    """
+    Read the expiry time from the payload of a JWT token, without verifying it.
 
-    requests.get("https://meteohub.mistralportal.it/auth/logout", headers={
-        'accept': 'application/json',
-        'Authorization': f'Bearer {token}'
-    })
+    :return: Unix time of expiry, now + default if it can't be read
+    """
+    try:
+        payload = token.split(".")[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["exp"])
+    except Exception:
+        return time.time() + default
 
-    if len(failed) > 0:
-        raise ValueError("Failed to download and process: {}".format(", ".join(failed)))
+
+def read_observations(data, stations):
+    """
+    Split the response of an observations query covering several stations into one frame per station.
+
+    Stations are matched on their coordinates. The values of all the parameters of a station are collected into one
+    long table and pivoted to one column per parameter.
+
+    :param data: List of stations in the "data" field of the response
+    :param stations: Stations covered by the query
+    :return: Dictionary {station id: DataFrame} with a time column and one column per parameter
+    """
+    frames = {}
+    for station in stations:
+        values = []
+        for item in data:
+            if abs(float(item["stat"]["lat"]) - station["lat"]) > 0.001 or abs(float(item["stat"]["lon"]) - station["lng"]) > 0.001:
+                continue
+            for p in item["prod"]:
+                if p["var"] in station["parameters"] and len(p["val"]) > 0:
+                    df = pd.DataFrame.from_records(p["val"], columns=["ref", "val"])
+                    df["var"] = p["var"]
+                    values.append(df)
+        order = list(dict.fromkeys(df["var"].iloc[0] for df in values))
+        columns = ["time"] + order + [p for p in station["parameters"] if p not in order]
+        if len(values) == 0:
+            frames[station["id"]] = pd.DataFrame(columns=columns)
+            continue
+        df = pd.concat(values, ignore_index=True).drop_duplicates(subset=["ref", "var"], keep="last")
+        df = df.pivot(index="ref", columns="var", values="val")
+        df.index = pd.to_datetime(df.index)
+        df = df.sort_index().rename_axis("time").reset_index()
+        df.columns.name = None
+        frames[station["id"]] = df.reindex(columns=columns)
+    return frames
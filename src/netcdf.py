@@ -0,0 +1,113 @@
+import os
+import netCDF4
+import zipfile
+import numpy as np
+
+
+def unzip_combine(path, compression=None, chunks=None):
+    """
+    Combine the NetCDF files of a zip along the time dimension into a single NetCDF file.
+
+    Members are read one at a time straight from the zip and appended to an output file with an unlimited time
+    dimension, memory use is bounded by the size of a single member. Data variables without a time dimension are
+    broadcast along time as xarray.concat does.
+
+    :param path: Path to the zip file, the output is written to the same path with a .nc extension
+    :param compression: netCDF4 compression keywords e.g. {"zlib": True, "complevel": 4}, defaults to the compression of the members
+    :param chunks: Dictionary of chunk sizes by dimension name, defaults to the chunking of the members
+    """
+    if ".zip" not in path:
+        raise ValueError("Path is not a zip file: {}".format(path))
+    out_file = path.replace(".zip", ".nc")
+    temp_file = out_file + ".part"
+    try:
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            members = sorted([f for f in zip_ref.namelist() if f.endswith(".nc") and os.path.dirname(f) == ""])
+            if not members:
+                raise ValueError("No NetCDF files found in {}".format(path))
+            with netCDF4.Dataset(temp_file, "w") as out:
+                out.set_auto_maskandscale(False)
+                for i, member in enumerate(members):
+                    with netCDF4.Dataset(member, memory=zip_ref.read(member)) as nc:
+                        nc.set_auto_maskandscale(False)
+                        if i == 0:
+                            create_combined(out, nc, compression=compression, chunks=chunks)
+                        append_combined(out, nc)
+        os.replace(temp_file, out_file)
+        os.unlink(path)
+    except:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+        raise ValueError("Failed to unzip and combine {}".format(path))
+
+
+def create_combined(out, nc, dim="time", compression=None, chunks=None):
+    """
+    Create the dimensions, variables and attributes of a combined NetCDF file from its first member.
+    """
+    out.setncatts({k: nc.getncattr(k) for k in nc.ncattrs()})
+    for name, dimension in nc.dimensions.items():
+        out.createDimension(name, None if name == dim else len(dimension))
+    coordinates = set(nc.dimensions.keys())
+    for var in nc.variables.values():
+        coordinates.update(getattr(var, "coordinates", "").split())
+    for name, var in nc.variables.items():
+        dimensions = var.dimensions
+        if dim in nc.dimensions and dim not in dimensions and name not in coordinates:
+            dimensions = (dim,) + dimensions
+        filters = var.filters() or {}
+        if compression is None:
+            kwargs = {"zlib": filters.get("zlib", False), "complevel": filters.get("complevel", 4), "shuffle": filters.get("shuffle", False)}
+        else:
+            kwargs = dict(compression)
+        if chunks:
+            kwargs["chunksizes"] = [chunks.get(d, max(len(nc.dimensions[d]), 1)) for d in dimensions]
+        elif dimensions == var.dimensions and isinstance(var.chunking(), list):
+            kwargs["chunksizes"] = var.chunking()
+        attributes = {k: var.getncattr(k) for k in var.ncattrs()}
+        fill_value = attributes.pop("_FillValue", None)
+        out_var = out.createVariable(name, var.datatype, dimensions, fill_value=fill_value, **kwargs)
+        # Values are copied packed, as read from the members, Dataset.set_auto_maskandscale only applies to the
+        # variables that existed when it was called
+        out_var.set_auto_maskandscale(False)
+        out_var.setncatts(attributes)
+
+
+def append_combined(out, nc, dim="time"):
+    """
+    Append the time slab of a NetCDF member to a combined NetCDF file created with create_combined.
+    """
+    start = len(out.dimensions[dim]) if dim in out.dimensions else 0
+    length = len(nc.dimensions[dim]) if dim in nc.dimensions else 0
+    for name, var in out.variables.items():
+        if name not in nc.variables:
+            raise ValueError("Variable {} not found in all NetCDF files".format(name))
+        source = nc.variables[name]
+        if dim not in var.dimensions:
+            if start == 0:
+                var[...] = source[...]
+            continue
+        data = source[...]
+        if dim not in source.dimensions:
+            data = np.broadcast_to(data, (length,) + data.shape)
+        elif " since " in getattr(source, "units", "") and source.units != getattr(var, "units", source.units):
+            calendar = getattr(source, "calendar", "standard")
+            data = netCDF4.date2num(netCDF4.num2date(data, source.units, calendar), var.units, calendar).astype(var.dtype)
+        index = [slice(None)] * len(var.dimensions)
+        index[var.dimensions.index(dim)] = slice(start, start + length)
+        var[tuple(index)] = data
+
+
+def set_dap_timeout(timeout):
+    """
+    Set the connect and read timeouts of the OPeNDAP requests made by netCDF4.
+
+    :param timeout: (connect, read) timeout in seconds, or a single timeout for both, as for fetcher
+    :return: True if the timeouts are set, False if the netCDF library does not support setting them
+    """
+    if not getattr(netCDF4, "__has_nc_rc_set__", False):
+        return False
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    netCDF4.rc_set("HTTP.CONNECTTIMEOUT", str(int(connect)))
+    netCDF4.rc_set("HTTP.TIMEOUT", str(int(read)))
+    return True
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import queue
+import pysftp
+import threading
+from stat import S_ISDIR
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class sftp_pool(object):
+    """
+    Pool of sftp connections for downloading several files at once.
+
+    Connections are opened on demand up to the pool size and reused between transfers. Connections that raise an error
+    are closed and replaced on the next request. Reads within a file are pipelined using the paramiko prefetch.
+    """
+    def __init__(self, host, username, password=None, private_key=None, port=22, connections=4, metrics=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.private_key = private_key
+        self.connections = connections
+        self.metrics = metrics
+        self.created = 0
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def connect(self):
+        cnopts = pysftp.CnOpts()
+        cnopts.hostkeys = None
+        return pysftp.Connection(host=self.host, port=self.port, username=self.username, password=self.password,
+                                 private_key=self.private_key, cnopts=cnopts)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.connections
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    conn = self.connect()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                conn = self.idle.get()
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self.lock:
+                self.created -= 1
+            raise
+        self.idle.put(conn)
+
+    def listdir(self, path):
+        with self.timer("list"), self.connection() as conn:
+            return conn.listdir(path)
+
+    def listdir_attr(self, path):
+        with self.timer("list"), self.connection() as conn:
+            return conn.listdir_attr(path)
+
+    @contextmanager
+    def timer(self, stage):
+        if self.metrics is None:
+            yield
+        else:
+            with self.metrics.timer(stage):
+                yield
+
+    def walk(self, path):
+        """
+        List the files below a remote folder.
+
+        :param path: Remote folder
+        :return: Dictionary {remote path: {"size": bytes, "mtime": modification time}} of all the nested files
+        """
+        files = {}
+        folders = [path]
+        while len(folders) > 0:
+            folder = folders.pop()
+            for attr in self.listdir_attr(folder):
+                remote = "{}/{}".format(folder.rstrip("/"), attr.filename)
+                if S_ISDIR(attr.st_mode):
+                    folders.append(remote)
+                else:
+                    files[remote] = {"size": attr.st_size, "mtime": attr.st_mtime}
+        return files
+
+    def get(self, remote, local, callback=None, attempts=3):
+        """
+        Download a file through a .part file that is resumed from its current size after a failed attempt.
+        The completed file is verified against the remote size and modification time and then moved into place.
+
+        :param remote: Remote file path
+        :param local: Local file path
+        :param callback: Progress callback called with (bytes transferred, total bytes)
+        :param attempts: Number of attempts, each on a healthy connection
+        """
+        for attempt in range(attempts):
+            try:
+                start = time.perf_counter()
+                with self.connection() as conn:
+                    download_resume(conn.sftp_client, remote, local, callback=callback)
+                if self.metrics is not None:
+                    self.metrics.add_time("download", time.perf_counter() - start)
+                    self.metrics.count("files")
+                    self.metrics.count("bytes", os.path.getsize(local))
+                return
+            except Exception:
+                if attempt == attempts - 1:
+                    raise
+                if self.metrics is not None:
+                    self.metrics.count("retries")
+
+    def map(self, jobs, callback=None):
+        """
+        Download files concurrently, one transfer per connection.
+
+        :param jobs: Iterable of tuples (key, remote path, local path)
+        :param callback: Progress callback passed to every transfer
+        :return: Generator of tuples (key, error) in order of completion, error is None if the transfer succeeded
+        """
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            futures = {executor.submit(self.get, remote, local, callback=callback): key for key, remote, local in jobs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    yield futures[future], None
+                except Exception as e:
+                    yield futures[future], e
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self.created = 0
+
+
+def download_resume(sftp, remote, local, callback=None, block=262144):
+    """
+    Download a remote file to local + ".part", resuming a previous partial download of the same remote file.
+
+    The remote size and modification time are stored next to the partial file so that a partial download is only
+    resumed if the remote file has not changed. The completed file gets the remote modification time and is renamed
+    into place atomically.
+
+    :param sftp: paramiko SFTPClient
+    :param remote: Remote file path
+    :param local: Local file path
+    :param callback: Progress callback called with (bytes transferred, total bytes)
+    :param block: Read size in bytes
+    """
+    part = local + ".part"
+    part_stat = part + ".json"
+    attr = sftp.stat(remote)
+    remote_stat = {"size": attr.st_size, "mtime": attr.st_mtime}
+
+    offset = 0
+    if os.path.exists(part):
+        try:
+            with open(part_stat, "r") as f:
+                if json.load(f) == remote_stat:
+                    offset = os.path.getsize(part)
+        except (OSError, ValueError):
+            pass
+        if offset > attr.st_size:
+            offset = 0
+    if offset == 0:
+        with open(part_stat, "w") as f:
+            json.dump(remote_stat, f)
+
+    with sftp.open(remote, "rb") as remote_file:
+        remote_file.seek(offset)
+        remote_file.prefetch(attr.st_size)
+        with open(part, "r+b" if offset > 0 else "wb") as local_file:
+            local_file.seek(offset)
+            local_file.truncate()
+            while offset < attr.st_size:
+                data = remote_file.read(block)
+                if not data:
+                    break
+                local_file.write(data)
+                offset += len(data)
+                if callback:
+                    callback(offset, attr.st_size)
+            local_file.flush()
+            os.fsync(local_file.fileno())
+
+    attr = sftp.stat(remote)
+    if {"size": attr.st_size, "mtime": attr.st_mtime} != remote_stat:
+        os.unlink(part)
+        os.unlink(part_stat)
+        raise ValueError("Remote file {} changed during download".format(remote))
+    if os.path.getsize(part) != attr.st_size:
+        raise ValueError("Incomplete download of {}: {} of {} bytes".format(remote, os.path.getsize(part), attr.st_size))
+    os.utime(part, (attr.st_atime, attr.st_mtime))
+    os.replace(part, local)
+    os.unlink(part_stat)
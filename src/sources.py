@@ -0,0 +1,141 @@
+import os
+import importlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+class source(object):
+    """
+    A data source that can be downloaded with main.py.
+
+    The module of a source is only imported when the source is run, so that a run only pays for the dependencies of
+    the sources it uses. Keep this module free of third party imports, it is loaded by main.py before any source.
+
+    :param name: Name of the source on the command line e.g. dwd_meteodata
+    :param module: Module of the download function
+    :param function: Name of the download function
+    :param call: Function (download function, params) calling the download function with the command line parameters
+    :param requires: Command line parameters that must be set e.g. ["password"]
+    :param backfill: The source supports --backfill
+    :param cpu: Processing dominates the run time, such sources run one after the other in a multi source run
+    """
+    def __init__(self, name, module, function, call, requires=(), backfill=False, cpu=False):
+        self.name = name
+        self.module = module
+        self.function = function
+        self.call = call
+        self.requires = list(requires)
+        self.backfill = backfill
+        self.cpu = cpu
+
+    def params(self, params):
+        """
+        Command line parameters for this source. Credentials can be set per source with the environment variables
+        {NAME}_USER, {NAME}_PASSWORD and {NAME}_KEY e.g. MISTRAL_METEODATA_PASSWORD, which take precedence over the
+        shared --user, --password and --key options.
+        """
+        params = dict(params)
+        for key in ["user", "password", "key"]:
+            value = os.environ.get("{}_{}".format(self.name.upper(), key.upper()))
+            if value:
+                params[key] = value
+        missing = [key for key in self.requires if not params.get(key)]
+        if missing:
+            raise ValueError("Missing {} for source {}".format(", ".join(missing), self.name))
+        if params.get("backfill") and not self.backfill:
+            raise ValueError("Backfill is not supported for source {}".format(self.name))
+        return params
+
+    def run(self, params):
+        function = getattr(importlib.import_module(self.module), self.function)
+        return self.call(function, params)
+
+
+registry = {s.name: s for s in [
+    source("meteoswiss_cosmo", "meteoswiss", "cosmo",
+           lambda f, p: f(p["filesystem"], p["password"], connections=p["connections"]),
+           requires=["password"], cpu=True),
+    source("meteoswiss_icon", "meteoswiss", "icon",
+           lambda f, p: f(p["filesystem"], p["password"], connections=p["connections"]),
+           requires=["password"], cpu=True),
+    source("meteoswiss_meteodata", "meteoswiss", "meteodata",
+           lambda f, p: f(p["filesystem"], p["password"], fmt=p["format"]),
+           requires=["password"], cpu=True),
+    source("bafu_hydrodata", "bafu", "hydrodata",
+           lambda f, p: f(p["filesystem"], p["key"], fmt=p["format"], connections=p["connections"], workers=p["workers"]),
+           requires=["key"], cpu=True),
+    source("arso_meteodata", "arso", "arso_meteodata",
+           lambda f, p: f(p["filesystem"], workers=p["workers"], fmt=p["format"], backfill=p["backfill"]),
+           backfill=True),
+    source("geosphere_meteodata", "geosphere", "geosphere_meteodata",
+           lambda f, p: f(p["filesystem"], workers=p["workers"], fmt=p["format"], backfill=p["backfill"]),
+           backfill=True),
+    source("mistral_meteodata", "mistral", "mistral_meteodata",
+           lambda f, p: f(p["filesystem"], p["user"], p["password"], workers=p["workers"], fmt=p["format"], backfill=p["backfill"]),
+           requires=["user", "password"], backfill=True),
+    source("thredds_meteodata", "thredds", "thredds_meteodata",
+           lambda f, p: f(p["filesystem"], workers=p["workers"], fmt=p["format"], backfill=p["backfill"]),
+           backfill=True),
+    source("dwd_meteodata", "dwd", "dwd_meteodata",
+           lambda f, p: f(p["filesystem"], workers=p["workers"], fmt=p["format"], backfill=p["backfill"]),
+           backfill=True, cpu=True),
+]}
+
+
+def select_sources(names):
+    """
+    :param names: "all" or a comma separated list of source names
+    :return: List of sources
+    """
+    if names == "all":
+        return list(registry.values())
+    selected = []
+    for name in [n.strip() for n in names.split(",") if n.strip()]:
+        if name not in registry:
+            raise ValueError("Unknown source {}, available sources: {}".format(name, ", ".join(registry)))
+        if registry[name] not in selected:
+            selected.append(registry[name])
+    return selected
+
+
+def run_sources(sources, params, parallel=4):
+    """
+    Run several sources in one process.
+
+    Up to parallel sources run at the same time on separate threads, each with its own download concurrency (--workers).
+    Sources that are limited by processing rather than downloads (cpu=True) run one after the other on a single thread
+    so that they overlap with the download bound sources instead of with each other. A failing source, including a
+    source missing its credentials or not supporting --backfill, does not stop the others.
+
+    :param sources: List of sources
+    :param params: Command line parameters
+    :param parallel: Maximum number of sources running at the same time
+    """
+    from functions import logger
+    log = logger("main", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="main")
+    log.initialise("Download {} sources".format(len(sources)))
+
+    def run_serial(group):
+        failed = []
+        for s in group:
+            try:
+                s.run(s.params(params))
+                log.info("Completed {}".format(s.name))
+            except Exception as e:
+                log.error("Failed {}".format(s.name), e)
+                failed.append(s.name)
+        return failed
+
+    groups = [[s for s in sources if s.cpu]] + [[s] for s in sources if not s.cpu]
+    groups = [group for group in groups if len(group) > 0]
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, min(parallel, len(groups)))) as executor:
+        for future in [executor.submit(run_serial, group) for group in groups]:
+            failed.extend(future.result())
+
+    log.count("sources", len(sources))
+    log.count("failed_sources", len(failed))
+    if len(failed) > 0:
+        log.close()
+        raise ValueError("Failed sources: {}".format(", ".join(failed)))
+    log.end("Downloaded {} sources".format(len(sources)))
+    log.close()
@@ -2,19 +2,19 @@ import os
 import time
 import json
 import netCDF4
-import tempfile
-import requests
 import numpy as np
 import pandas as pd
-from functools import reduce
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
-from functions import logger, merge_dfs
+from functions import logger, merge_station_year, fetcher, http_cache, backfill_checkpoint, watermarks
+from netcdf import set_dap_timeout
 
-def thredds_meteodata(data_folder):
+def thredds_meteodata(data_folder, workers=8, fmt="csv", backfill=None):
     """
     Download Meteodata from Thredds
     https://thredds-su.ipsl.fr/thredds/catalog/aeris_thredds/actrisfr_data/665029c8-82b8-4754-9ff4-d558e640b0ba/catalog.html
+
+    :param backfill: Tuple (start, end) of datetimes to backfill from the yearly files instead of the last four weeks
     """
     stations = [
         {"id": "73329001", "name": "CHAMBERY-AIX", "parameters": ["time","ta","rh","wd","ws","cumul_precip","glo"]},
@@ -22,7 +22,7 @@ def thredds_meteodata(data_folder):
     ]
     failed = []
 
-    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"))
+    log = logger("meteodata", path=os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "logs"), source="thredds_meteodata")
     log.initialise("Download Meteodata from Thredds")
 
     log.info("Ensure data folder exists.")
@@ -30,44 +30,139 @@ def thredds_meteodata(data_folder):
     if not os.path.exists(parent):
         os.makedirs(parent)
 
-    current_date = datetime.now()
+    current_date = datetime.utcnow()
     last_update = current_date - timedelta(weeks=4)
 
     url = "https://thredds-su.ipsl.fr/thredds/fileServer/aeris_thredds/actrisfr_data/665029c8-82b8-4754-9ff4-d558e640b0ba/{}/{}_{}_MTO_1H_{}.nc"
 
+    if backfill is not None:
+        log.info("Backfilling data from {} to {}".format(backfill[0], backfill[1]))
+        checkpoint = backfill_checkpoint(parent, backfill[0], backfill[1])
+        last_update, current_date = backfill[0], backfill[1] - timedelta(seconds=1)
+
+    marks = watermarks(parent)
+    fetch = fetcher(workers=workers, cache=http_cache(os.path.join(parent, ".cache")) if backfill is None else None, metrics=log.metrics)
+    jobs = []
+    starts = {}
     for station in stations:
-        log.info("Downloading data for station {}".format(station["id"]))
-        for year in range(last_update.year, current_date.year + 1):
-            with tempfile.NamedTemporaryFile(suffix=".nc", delete=False) as temp_file:
-                response = requests.get(url.format(year, station["id"], station["name"], year), stream=True)
-                if response.status_code == 200:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        temp_file.write(chunk)
-                else:
-                    print("{} ({})".format(station["id"], year))
-                    failed.append("{} ({})".format(station["id"], year))
-                    continue
-            try:
-                data = {}
-                with netCDF4.Dataset(temp_file.name) as nc:
-                    for parameter in station["parameters"]:
-                        data[parameter] = nc.variables[parameter][:]
-                df = pd.DataFrame(data)
-                df['time'] = pd.to_datetime(df['time'], unit='s', utc=True)
-                df = df.sort_values(by='time')
-                station_year_file = os.path.join(parent, station["id"], "{}.csv".format(year))
-                if not os.path.exists(station_year_file):
-                    log.info("Saving file new file {}.".format(station_year_file), indent=1)
-                    os.makedirs(os.path.dirname(station_year_file), exist_ok=True)
-                    df.to_csv(station_year_file, index=False)
-                else:
-                    df_existing = pd.read_csv(station_year_file)
-                    df_existing['time'] = pd.to_datetime(df_existing['time'])
-                    combined = pd.concat([df_existing, df])
-                    combined = combined.drop_duplicates(subset=['time'], keep='last')
-                    combined = combined.sort_values(by='time')
-                    combined.to_csv(station_year_file, index=False)
-            except:
-                failed.append("{} ({})".format(station["id"], year))
+        if backfill is None:
+            starts[station["id"]] = marks.start(station["id"], station["parameters"][1:], last_update)
+        else:
+            starts[station["id"]] = last_update
+        for year in range(starts[station["id"]].year, current_date.year + 1):
+            if backfill is not None and checkpoint.finished("{} ({})".format(station["id"], year)):
+                continue
+            jobs.append(((station, year), url.format(year, station["id"], station["name"], year)))
+
+    end = backfill[1] if backfill is not None else None
+    frames = {}
+    fallback = []
+    dap = set_dap_timeout(fetch.timeout)
+    if dap:
+        log.info("Reading {} files for {} stations over OPeNDAP".format(len(jobs), len(stations)))
+    else:
+        log.warning("OPeNDAP requests cannot be given a timeout with this netCDF library, downloading the files.")
+        fallback = list(jobs)
+    for (station, year), file_url in (jobs if dap else []):
+        try:
+            with log.timer("download"):
+                nc = netCDF4.Dataset(file_url.replace("/fileServer/", "/dodsC/"))
+        except OSError as e:
+            log.info("Downloading {} ({}), failed to open over OPeNDAP: {}".format(station["id"], year, e), indent=1)
+            fallback.append(((station, year), file_url))
+            continue
+        try:
+            with log.timer("download"), nc:
+                frames[(station["id"], year)] = read_thredds(nc, station["parameters"], starts[station["id"]], end)
+        except (OSError, RuntimeError) as e:
+            log.info("Downloading {} ({}), failed to read over OPeNDAP: {}".format(station["id"], year, e), indent=1)
+            fallback.append(((station, year), file_url))
+        except Exception as e:
+            log.error("Failed to read {} ({})".format(station["id"], year), e, indent=1)
+            failed.append("{} ({})".format(station["id"], year))
+
+    if len(fallback) > 0:
+        log.info("Downloading {} files".format(len(fallback)))
+    for (station, year), response in fetch.map(fallback):
+        if isinstance(response, Exception) or response.status_code not in [200, 304]:
+            print("{} ({})".format(station["id"], year))
+            failed.append("{} ({})".format(station["id"], year))
+            continue
+        file_url = url.format(year, station["id"], station["name"], year)
+        if response.status_code == 304 and marks.start(station["id"], station["parameters"][1:], None) is not None:
+            log.info("Not modified {} ({})".format(station["id"], year), indent=1)
+            continue
+        try:
+            content = response.content if response.status_code == 200 else fetch.cache.load(file_url)
+            with log.timer("parse"), netCDF4.Dataset(os.path.basename(file_url), memory=content) as nc:
+                frames[(station["id"], year)] = read_thredds(nc, station["parameters"], starts[station["id"]], end)
+        except:
+            failed.append("{} ({})".format(station["id"], year))
+            if fetch.cache is not None:
+                fetch.cache.remove(file_url)
+
+    for (station, year), file_url in jobs:
+        if (station["id"], year) not in frames:
+            continue
+        log.info("Processing data for station {} ({})".format(station["id"], year))
+        try:
+            df = frames.pop((station["id"], year))
+            station_year_file = os.path.join(parent, station["id"], "{}.{}".format(year, fmt))
+            with log.timer("merge"):
+                status = merge_station_year(station_year_file, df)
+            log.count("rows", len(df))
+            if status == "new":
+                log.info("Saving file new file {}.".format(station_year_file), indent=1)
+            marks.update(station["id"], df)
+            if backfill is not None:
+                checkpoint.complete("{} ({})".format(station["id"], year))
+        except:
+            failed.append("{} ({})".format(station["id"], year))
+            if fetch.cache is not None:
+                fetch.cache.remove(file_url)
+
+    fetch.close()
+    marks.save()
+    if fetch.cache is not None:
+        log.info("HTTP cache: {} hits, {} misses".format(fetch.cache.hits, fetch.cache.misses))
+        log.count("cache_hits", fetch.cache.hits)
+        log.count("cache_misses", fetch.cache.misses)
+    log.close()
+
+    if backfill is not None and len(failed) == 0:
+        checkpoint.finish()
+
     if len(failed) > 0:
         raise ValueError("Failed to download and process: {}".format(", ".join(failed)))
+
+
+def read_thredds(nc, parameters, start, end=None):
+    """
+    Read the rows of a Thredds station file between two times.
+
+    The time variable (seconds since 1970) is binary searched and only the matching index range of the parameters is
+    read, over OPeNDAP only this range is transferred.
+
+    :param nc: netCDF4 Dataset, remote or in memory
+    :param parameters: List of variables to read, starting with time
+    :param start: Start datetime (naive UTC), inclusive
+    :param end: End datetime (naive UTC), exclusive, None to read until the end of the file
+    :return: DataFrame sorted by time with a UTC time column
+    """
+    times = np.asarray(nc.variables["time"][:], dtype=np.float64)
+    first, last = 0, len(times)
+    if (np.diff(times) >= 0).all():
+        first = int(np.searchsorted(times, pd.Timestamp(start).timestamp(), side="left"))
+        if end is not None:
+            last = int(np.searchsorted(times, pd.Timestamp(end).timestamp(), side="left"))
+    data = {"time": times[first:last]}
+    for parameter in parameters:
+        if parameter != "time":
+            data[parameter] = nc.variables[parameter][first:last]
+    df = pd.DataFrame(data)
+    df['time'] = pd.to_datetime(df['time'], unit='s', utc=True)
+    df = df.sort_values(by='time')
+    df = df[df["time"] >= pd.Timestamp(start, tz="UTC")]
+    if end is not None:
+        df = df[df["time"] < pd.Timestamp(end, tz="UTC")]
+    return df